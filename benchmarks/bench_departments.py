@@ -0,0 +1,127 @@
+"""Benchmark of departments_from_project_name.
+
+Compares the current matcher with the previous implementation (one regex
+search per department and region name), checks that both return the same
+departments, and reports the throughput of each.
+
+Usage: python benchmarks/bench_departments.py [--repeat N]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from scraper.departments import (  # noqa: E402
+    DEPARTMENTS,
+    REGIONS,
+    departments_from_project_name,
+)
+
+TITLES_PATH = os.path.join(os.path.dirname(__file__), "project_titles.txt")
+
+
+def legacy_departments_from_project_name(project_name):
+    """Previous implementation, kept as the reference."""
+
+    departments = []
+
+    matches_parentheses = re.findall(
+        r"\(([A-B0-9 \-,;//\+]+(?: et[A-B0-9 \-,;//]+)?)\)", project_name
+    )
+
+    for m in matches_parentheses:
+        m = m.replace("+", " ")
+
+        match_dept_nos = re.findall(
+            r"\b([02][1-9]|2[AB]|[1345678][0-9]|9[012345]|97[1-8])\b", m
+        )
+
+        if match_dept_nos:
+            for d in match_dept_nos:
+                departments.append(d)
+
+    if not departments:
+        for dept in DEPARTMENTS:
+            dept_no_hyphens = dept.replace("-", " ")
+
+            if re.search(rf"\({dept}\)", project_name, re.IGNORECASE) or re.search(
+                rf"\({dept_no_hyphens}\)$", project_name, re.IGNORECASE
+            ):
+                departments.append(DEPARTMENTS[dept])
+
+    if not departments:
+        for reg in REGIONS:
+            reg_no_hyphens = reg.replace("-", " ")
+
+            if re.search(
+                rf"\brégion {reg}\b", project_name, re.IGNORECASE
+            ) or re.search(
+                rf"\brégion {reg_no_hyphens}\b", project_name, re.IGNORECASE
+            ):
+                for d in REGIONS[reg]:
+                    departments.append(d)
+
+    departments = sorted(list(set(departments)))
+
+    return departments
+
+
+def load_titles():
+    """Returns the corpus titles, plus every department and region name in the
+    forms the matchers accept."""
+
+    with open(TITLES_PATH, "r") as file:
+        titles = [line.strip() for line in file if line.strip()]
+
+    for dept in DEPARTMENTS:
+        titles.append(f"Projet ({dept})")
+        titles.append(f"Projet ({dept.replace('-', ' ')})")
+        titles.append(f"Projet ({dept.upper()}) à l'étude")
+    for reg in REGIONS:
+        titles.append(f"Schéma de la région {reg}")
+        titles.append(f"Schéma de la Région {reg.replace('-', ' ')}")
+
+    return titles
+
+
+def run(function, titles, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for title in titles:
+            function(title)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    titles = load_titles()
+
+    mismatches = [
+        title
+        for title in titles
+        if departments_from_project_name(title)
+        != legacy_departments_from_project_name(title)
+    ]
+    for title in mismatches:
+        print(f"Mismatch: {title!r}")
+    if mismatches:
+        sys.exit(1)
+
+    items = len(titles) * args.repeat
+    before = run(legacy_departments_from_project_name, titles, args.repeat)
+    after = run(departments_from_project_name, titles, args.repeat)
+
+    print(f"{len(titles)} titles x {args.repeat}, same departments for all")
+    print(f"before: {items / before:10.0f} items/s")
+    print(f"after:  {items / after:10.0f} items/s ({before / after:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
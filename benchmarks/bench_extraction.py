@@ -0,0 +1,269 @@
+"""Benchmark of the extraction of the documents of the documents pages.
+
+Compares scraper.extraction (one pass over the lxml tree, XPath compiled once)
+with the previous implementation (Scrapy selectors, a CSS query per block and
+box), checks that both return the same documents on the pages of
+benchmarks/fixtures, and reports the throughput of each, on the fixtures and
+on large archive pages (the boxes of the fixtures repeated --scale times).
+
+Usage: python benchmarks/bench_extraction.py [--repeat N] [--scale N]
+"""
+
+import argparse
+import copy
+import re
+import sys
+import time
+
+from lxml import html
+from scrapy import Request
+from scrapy.http import HtmlResponse
+
+from common import BASE_URL, DOCUMENTS_PAGES, TARGET_YEARS, read_fixture
+from scraper.extraction import AUTHORITY, extract_documents
+
+
+def legacy_extract_documents(response, category_local, target_years):
+    """Previous implementation (loops of parse_documents_page), kept as the
+    reference. Yields (document fields, listing date)."""
+
+    if category_local == "Avis rendus":
+
+        page_title = response.xpath("//title/text()").get()
+        page_year = re.search(r"20\d\d", page_title)[0]
+
+        content_elements = response.css("#contenu .contenu-article .texte-article > *")
+
+        decision_date_string = None
+        for elem in content_elements:
+            if elem.css("h2"):
+                decision_date_line = elem.css("h2::text").get()
+                decision_date_string = decision_date_line.replace("Séance du ", "")
+
+            elif elem.css(".texteencadre-spip"):
+
+                encadre = elem.css(".texteencadre-spip")
+
+                if encadre.css("a.fr-download__link"):
+
+                    full_info = "".join(
+                        [x for x in encadre.css("::text").getall() if x != "NOUVEAU"]
+                    )
+
+                    project = encadre.css(".fr-download__link ::text").get().strip()
+
+                    if "cadrage préalable" in project.lower():
+                        title = "Cadrage préalable"
+                    else:
+                        title = "Avis"
+
+                    doc_link = encadre.css("a.fr-download__link").attrib["href"]
+
+                    doc_item = dict(
+                        title=title,
+                        project=project,
+                        authority=AUTHORITY,
+                        category_local=category_local,
+                        source_file_url=response.urljoin(doc_link),
+                        source_page_url=response.request.url,
+                        full_info=full_info,
+                        year=page_year,
+                    )
+
+                    for y in target_years:
+                        if str(y) in page_title:
+                            doc_item["year"] = str(y)
+                            yield dict(doc_item), decision_date_string
+
+    elif category_local.startswith("Décisions de cas par cas"):
+
+        page_title = response.xpath("//title/text()").get()
+        page_year = re.search(r"20\d\d", page_title)[0]
+
+        content_elements = response.css("#contenu .contenu-article .texte-article > *")
+
+        for elem in content_elements:
+            if elem.css("h2"):
+                continue
+
+            elif elem.css(".texteencadre-spip"):
+
+                encadre = elem.css(".texteencadre-spip")
+
+                full_info = "".join(encadre.css("::text").getall())
+
+                project_link = encadre.css("a.spip_out::text")
+                if project_link:
+                    project = project_link.get().strip()
+                else:
+                    project_match = re.search(
+                        "Nom et formulaire du dossier\xa0: (.*)\n", full_info
+                    )
+                    if project_match:
+                        project = project_match.group(1).strip()
+                    else:
+                        project = "ERROR"
+
+                box_links = encadre.css("a.fr-download__link")
+                for link in box_links:
+                    link_url = link.attrib["href"]
+                    link_text = link.css("::text").get().strip()
+                    if link_text in ["OUI", "NON"]:
+                        title = f"Décision ({link_text})"
+                    else:
+                        title = link_text.strip()
+
+                    yield dict(
+                        title=title,
+                        category_local=category_local,
+                        authority=AUTHORITY,
+                        full_info=full_info,
+                        project=project,
+                        source_page_url=response.request.url,
+                        source_file_url=response.urljoin(link_url),
+                        year=page_year,
+                    ), None
+
+                simple_links = encadre.css("a.spip_out")
+                for index, link in enumerate(simple_links):
+                    file_url = link.attrib["href"]
+                    if index == 0:
+                        title = "Formulaire"
+                    else:
+                        title = link.css("::text").get().strip()
+
+                    yield dict(
+                        title=title,
+                        category_local=category_local,
+                        authority=AUTHORITY,
+                        full_info=full_info,
+                        project=project,
+                        source_page_url=response.request.url,
+                        source_file_url=response.urljoin(file_url),
+                        year=page_year,
+                    ), None
+
+    elif category_local == "Saisines":
+
+        download_boxes = response.css("#main .texte-article .fr-download")
+
+        for dl_box in download_boxes:
+
+            doc_title = "".join(
+                [
+                    x.strip()
+                    for x in dl_box.css("a.fr-download__link::text").getall()
+                    if x.strip()
+                ]
+            )
+            doc_link = dl_box.css("a.fr-download__link").attrib["href"]
+
+            preceding_p = dl_box.xpath("./preceding-sibling::p")[-1]
+
+            project = preceding_p.css("strong").css("::text").get()
+
+            date_string = preceding_p.css("::text")[-1].get()
+
+            year = int(re.search(r"20\d\d", date_string).group())
+
+            if year in target_years:
+                yield dict(
+                    title=f"Accusé de reception - {doc_title}",
+                    project=project,
+                    authority=AUTHORITY,
+                    category_local=category_local,
+                    source_file_url=response.urljoin(doc_link),
+                    source_page_url=response.request.url,
+                    year=str(year),
+                ), date_string
+
+
+def extract(response, category_local):
+    documents = []
+    for record in extract_documents(response, category_local, TARGET_YEARS):
+        listing_date = record.pop("listing_date", None)
+        documents.append((record, listing_date))
+    return documents
+
+
+def legacy_extract(response, category_local):
+    return list(legacy_extract_documents(response, category_local, TARGET_YEARS))
+
+
+def archive_page(body, scale):
+    """A large archive page: the content of the article repeated `scale` times."""
+
+    tree = html.fromstring(body)
+    for article in tree.find_class("texte-article"):
+        children = list(article)
+        for _ in range(scale - 1):
+            article.extend(copy.deepcopy(child) for child in children)
+    return html.tostring(tree, encoding="utf-8")
+
+
+def load_responses(scale):
+    responses = {}
+
+    for name, (fixture, path, category_local) in DOCUMENTS_PAGES.items():
+        body = read_fixture(fixture)
+
+        request = Request(BASE_URL + path)
+        for page_name, page_body in [
+            (name, body),
+            (f"{name} x{scale}", archive_page(body, scale)),
+        ]:
+            responses[page_name] = (
+                HtmlResponse(
+                    request.url, body=page_body, encoding="utf-8", request=request
+                ),
+                category_local,
+            )
+
+    return responses
+
+
+def run(function, response, category_local, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        # Fresh response, as selectors are cached on the response
+        function(response.replace(), category_local)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=int, default=10)
+    args = parser.parse_args()
+
+    responses = load_responses(args.scale)
+
+    mismatches = [
+        name
+        for name, (response, category_local) in responses.items()
+        if extract(response.replace(), category_local)
+        != legacy_extract(response.replace(), category_local)
+    ]
+    for name in mismatches:
+        print(f"Mismatch: {name}")
+    if mismatches:
+        sys.exit(1)
+
+    print(
+        f"{'page':<26} {'documents':>9} {'before docs/s':>14} {'after docs/s':>13}"
+        f" {'speedup':>8}"
+    )
+
+    for name, (response, category_local) in responses.items():
+        documents = len(extract(response.replace(), category_local))
+        before = run(legacy_extract, response, category_local, args.repeat)
+        after = run(extract, response, category_local, args.repeat)
+
+        print(
+            f"{name:<26} {documents:>9} {documents * args.repeat / before:>14.0f}"
+            f" {documents * args.repeat / after:>13.0f} {before / after:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
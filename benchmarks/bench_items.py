@@ -0,0 +1,129 @@
+"""Memory benchmark of the documents in flight, with and without COMPACT_ITEMS.
+
+Follows --documents documents from copies of the documents pages of
+benchmarks/fixtures (at distinct URLs), answers their HEAD requests with the
+headers of a typical PDF response, and passes the items through
+HandleErrorsPipeline, as before their upload. Reports the memory held by the
+documents waiting for their HEAD request, by the items waiting for their upload,
+and the peak memory allocated, for each mode.
+
+Usage: python benchmarks/bench_items.py [--documents N]
+"""
+
+import argparse
+import logging
+import os
+import tracemalloc
+from contextlib import redirect_stdout
+
+from scrapy import Request
+from scrapy.http import HtmlResponse, Response
+
+from common import BASE_URL, DOCUMENTS_PAGES, make_spider, read_fixture
+from scraper.pipelines import HandleErrorsPipeline
+
+# Headers of the HEAD responses of the documents
+DOCUMENT_RESPONSE_HEADERS = {
+    "Date": "Thu, 14 Nov 2024 09:12:45 GMT",
+    "Server": "Apache",
+    "Strict-Transport-Security": "max-age=31536000; includeSubDomains; preload",
+    "X-Frame-Options": "SAMEORIGIN",
+    "X-Content-Type-Options": "nosniff",
+    "Last-Modified": "Tue, 12 Mar 2024 14:03:21 GMT",
+    "ETag": '"1b2f4a-6137a2c4b8e40"',
+    "Accept-Ranges": "bytes",
+    "Content-Length": "1781578",
+    "Cache-Control": "max-age=2592000, public",
+    "Expires": "Sat, 14 Dec 2024 09:12:45 GMT",
+    "Content-Type": "application/pdf",
+    "Set-Cookie": "TS01a2b3c4=01f2e3d4c5b6a79881726354; Path=/; Secure; HTTPOnly",
+}
+
+
+def load_pages():
+    pages = []
+    for fixture, path, category_local in DOCUMENTS_PAGES.values():
+        pages.append((read_fixture(fixture), path, category_local))
+    return pages
+
+
+def follow_documents(spider, pages, documents):
+    """Parses copies of the documents pages until `documents` HEAD requests
+    are yielded."""
+
+    requests = []
+    copy = 0
+
+    while len(requests) < documents:
+        for body, path, category_local in pages:
+            url = f"{BASE_URL}archives-{copy}/{path}"
+            response = HtmlResponse(
+                url, body=body, encoding="utf-8", request=Request(url)
+            )
+            requests.extend(
+                output
+                for output in spider.parse_documents_page(response, category_local)
+                if isinstance(output, Request)
+            )
+        copy += 1
+
+    return requests[:documents]
+
+
+def measure(compact, pages, documents):
+    spider = make_spider(COMPACT_ITEMS=compact)
+    pipeline = HandleErrorsPipeline()
+    pipeline.spider = spider
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    requests = follow_documents(spider, pages, documents)
+    in_flight = tracemalloc.get_traced_memory()[0] - baseline
+
+    items = []
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        while requests:
+            request = requests.pop()
+            response = Response(
+                request.url, headers=DOCUMENT_RESPONSE_HEADERS, request=request
+            )
+            for item in spider.parse_document_headers(response, **request.cb_kwargs):
+                items.append(pipeline.process_item(item))
+    queued = tracemalloc.get_traced_memory()[0] - baseline
+
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    return len(items), in_flight, queued, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=10000)
+    args = parser.parse_args()
+
+    # Documents with errors are logged by HandleErrorsPipeline
+    logging.disable(logging.WARNING)
+
+    pages = load_pages()
+
+    print(
+        f"{'mode':<10} {'items':>7} {'in flight MiB':>14} {'queued MiB':>11}"
+        f" {'peak MiB':>9} {'peak KiB/item':>14}"
+    )
+
+    results = {}
+    for mode, compact in [("before", False), ("compact", True)]:
+        items, in_flight, queued, peak = measure(compact, pages, args.documents)
+        results[mode] = peak
+        print(
+            f"{mode:<10} {items:>7} {in_flight / 2**20:>14.1f} {queued / 2**20:>11.1f}"
+            f" {peak / 2**20:>9.1f} {peak / items / 1024:>14.2f}"
+        )
+
+    print(f"peak memory: {results['compact'] / results['before']:.0%} of before")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Parse-throughput benchmark of the IGEDD spider callbacks.
+
+Feeds the pages of benchmarks/fixtures to the IGEDDSpider.parse* callbacks as
+HtmlResponse objects, without network access, and reports pages/s, items/s
+(documents and requests yielded) and the peak memory allocated while parsing.
+
+The fixtures are synthetic pages following the markup of the IGEDD site (DSFR
+tiles and cards, SPIP boxes), with both "Décisions de cas par cas" layouts.
+The number of outputs of each page is checked against EXPECTED, so that a
+parser change that loses documents fails the benchmark.
+
+Usage: python benchmarks/bench_parse.py [--repeat N] [--only NAME]
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+from scrapy import Request
+from scrapy.http import HtmlResponse
+
+from common import BASE_URL, DOCUMENTS_PAGES, make_spider, read_fixture
+
+# name: (fixture, url, callback, category_local)
+PAGES = {
+    "home": (
+        "home.html",
+        "l-autorite-environnementale-r145.html",
+        "parse",
+        None,
+    ),
+    "current_or_archives": (
+        "cas-par-cas-projets.html",
+        "decisions-de-cas-par-cas-sur-des-projets-r506.html",
+        "parse_current_or_archives_page",
+        "Décisions de cas par cas sur des projets",
+    ),
+    "year_selection_current": (
+        "avis-rendus-en-2024.html",
+        "avis-rendus-en-2024-r708.html",
+        "parse_year_selection_page",
+        "Avis rendus",
+    ),
+    "year_selection_archives": (
+        "archives-des-avis-rendus.html",
+        "archives-des-avis-rendus-r470.html",
+        "parse_year_selection_page",
+        "Avis rendus",
+    ),
+    **{
+        name: (fixture, path, "parse_documents_page", category_local)
+        for name, (fixture, path, category_local) in DOCUMENTS_PAGES.items()
+    },
+}
+
+# Number of outputs (requests and items) of each page
+EXPECTED = {
+    "home": 5,
+    "current_or_archives": 2,
+    "year_selection_current": 1,
+    "year_selection_archives": 1,
+    "avis_rendus": 72,
+    "cas_par_cas_projets": 88,
+    "cas_par_cas_plans": 53,
+    "saisines": 60,
+}
+
+
+def load_responses():
+    responses = {}
+
+    for name, (fixture, path, callback, category_local) in PAGES.items():
+        body = read_fixture(fixture)
+
+        cb_kwargs = {"category_local": category_local} if category_local else {}
+        request = Request(BASE_URL + path, cb_kwargs=cb_kwargs)
+        responses[name] = (
+            HtmlResponse(request.url, body=body, encoding="utf-8", request=request),
+            callback,
+        )
+
+    return responses
+
+
+def parse(spider, response, callback):
+    # New spider state each time, so that documents pages are never skipped
+    # as unchanged or already seen
+    spider.scraper_state = {}
+    spider.pending_documents.clear()
+    spider.parsed_pages.clear()
+    spider.seen_documents.clear()
+
+    # Fresh response, as selectors are cached on the response
+    response = response.replace()
+
+    return list(getattr(spider, callback)(response, **response.request.cb_kwargs))
+
+
+def measure(spider, response, callback, repeat):
+    outputs = len(parse(spider, response, callback))
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parse(spider, response, callback)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    parse(spider, response, callback)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return outputs, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--only", choices=PAGES, action="append")
+    args = parser.parse_args()
+
+    spider = make_spider()
+    responses = load_responses()
+
+    print(
+        f"{'page':<24} {'callback':<31} {'outputs':>7} {'pages/s':>9} "
+        f"{'items/s':>10} {'peak KiB':>9}"
+    )
+
+    failed = []
+    total_pages = total_outputs = total_elapsed = 0
+
+    for name, (response, callback) in responses.items():
+        if args.only and name not in args.only:
+            continue
+
+        outputs, elapsed, peak = measure(spider, response, callback, args.repeat)
+
+        total_pages += args.repeat
+        total_outputs += outputs * args.repeat
+        total_elapsed += elapsed
+
+        print(
+            f"{name:<24} {callback:<31} {outputs:>7} {args.repeat / elapsed:>9.1f} "
+            f"{outputs * args.repeat / elapsed:>10.1f} {peak / 1024:>9.0f}"
+        )
+
+        if outputs != EXPECTED[name]:
+            failed.append(f"{name}: {outputs} outputs, expected {EXPECTED[name]}")
+
+    print(
+        f"{'total':<56} {total_pages / total_elapsed:>9.1f} "
+        f"{total_outputs / total_elapsed:>10.1f}"
+    )
+
+    for failure in failed:
+        print(f"Unexpected number of outputs for {failure}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Fixtures and spider shared by the benchmarks of the spider callbacks."""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from scrapy.settings import Settings  # noqa: E402
+from scrapy.utils.reactor import install_reactor  # noqa: E402
+from scrapy.utils.test import get_crawler  # noqa: E402
+
+from scraper import settings as scraper_settings  # noqa: E402
+from scraper.spiders.igedd import IGEDDSpider  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+BASE_URL = "https://www.igedd.developpement-durable.gouv.fr/"
+
+TARGET_YEARS = [2023, 2024]
+
+# Documents pages: name: (fixture, url, category_local)
+DOCUMENTS_PAGES = {
+    "avis_rendus": (
+        "avis-2024.html",
+        "2024-r708.html",
+        "Avis rendus",
+    ),
+    "cas_par_cas_projets": (
+        "cas-par-cas-projets-2024.html",
+        "2024-en-cours-d-examen-et-decisions-rendues-r755.html",
+        "Décisions de cas par cas sur des projets",
+    ),
+    "cas_par_cas_plans": (
+        "cas-par-cas-plans-2024.html",
+        "2024-en-cours-d-examen-et-decisions-rendues-r750.html",
+        "Décisions de cas par cas sur des plans-programmes",
+    ),
+    "saisines": (
+        "saisines.html",
+        "les-saisines-de-l-autorite-environnementale-du-a417.html",
+        "Saisines",
+    ),
+}
+
+
+def read_fixture(fixture):
+    with open(os.path.join(FIXTURES_DIR, fixture), "rb") as file:
+        return file.read()
+
+
+def make_spider(**settings):
+    """A spider with the project settings (and `settings`), whose callbacks
+    are called directly, without crawling. Documents are always requested with
+    a HEAD request."""
+
+    project_settings = Settings()
+    project_settings.setmodule(scraper_settings)
+    install_reactor(project_settings["TWISTED_REACTOR"])
+
+    crawler = get_crawler(
+        IGEDDSpider,
+        {
+            **project_settings.copy_to_dict(),
+            "HEAD_FREE_DATES": False,
+            "HEAD_CACHE_TTL": 0,
+            **settings,
+        },
+    )
+    spider = IGEDDSpider.from_crawler(crawler)
+    crawler.spider = spider
+
+    spider.target_years = TARGET_YEARS
+    spider.upload_limit = 0
+    spider.time_limit = 0
+    spider.event_data = {}
+    spider.scraper_state = {}
+
+    return spider
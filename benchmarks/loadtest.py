@@ -0,0 +1,180 @@
+"""End-to-end load test of the add-on against a local replay of the site.
+
+Starts the servers of benchmarks/replay.py, then runs main.py as the add-on
+would be run on DocumentCloud (a run id and an event id, so that documents are
+uploaded and event data is stored), pointed to the replay servers. Reports the
+total run time, the requests received by the site and the API, and the upload
+throughput.
+
+Scraper settings can be overridden with --set, for instance to compare
+download delays, AutoThrottle or upload concurrency:
+
+    python benchmarks/loadtest.py --set DOWNLOAD_DELAY=0.5 --set UPLOAD_CONCURRENCY=8
+
+With --runs N, the runs share the event data stored on the fake API, like the
+scheduled runs of an add-on event. With --shards N, the years (or categories,
+with --shard-by categories) are split between N processes.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import replay
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def get_stats(server):
+    with urllib.request.urlopen(f"{server.url}/_stats") as response:
+        return json.load(response)
+
+
+def stats_delta(before, after):
+    return {key: value - before.get(key, 0) for key, value in after.items()}
+
+
+def setting(text):
+    name, _, value = text.partition("=")
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def run_addon(args, site, api, run_number, work_dir):
+    """Runs main.py once and returns its duration."""
+
+    overrides = {
+        "START_URL": site.url + replay.START_PATH,
+        "LOG_FILE": os.path.join(work_dir, f"run-{run_number}.log"),
+        **dict(args.set),
+    }
+    env = {
+        **os.environ,
+        "PYTHONPATH": ROOT_DIR,
+        "SCRAPY_SETTINGS_MODULE": "benchmarks.loadtest_settings",
+        "LOADTEST_SETTINGS": json.dumps(overrides),
+    }
+    blob = {
+        "id": f"loadtest-{run_number}",
+        "event_id": 1,
+        "data": {
+            "run_name": f"load test {run_number}",
+            "project": "1",
+            "access_level": "private",
+            "from_year": args.from_year,
+            "to_year": args.to_year,
+            "upload_limit": args.upload_limit,
+            "time_limit": args.time_limit,
+            "dry_run": False,
+            "shards": args.shards,
+            "shard_by": args.shard_by,
+        },
+    }
+
+    start = time.perf_counter()
+    with open(os.path.join(work_dir, f"run-{run_number}.out"), "w") as output:
+        process = subprocess.run(
+            [
+                sys.executable,
+                os.path.join(ROOT_DIR, "main.py"),
+                "--base_uri",
+                f"{api.url}/api/",
+                "--token",
+                "loadtest",
+                json.dumps(blob),
+            ],
+            cwd=work_dir,
+            env=env,
+            stdout=output,
+            stderr=subprocess.STDOUT,
+        )
+    elapsed = time.perf_counter() - start
+
+    if process.returncode:
+        print(f"Run {run_number} failed, see {output.name}")
+
+    return elapsed
+
+
+def report(run_number, elapsed, site_stats, api_stats):
+    uploads = api_stats.get("documents/created", 0)
+
+    print(f"Run {run_number}: {elapsed:.1f}s")
+    print(
+        f"  site: {site_stats.get('requests/GET', 0)} GET, "
+        f"{site_stats.get('requests/HEAD', 0)} HEAD, "
+        f"{site_stats.get('responses/304', 0)} x 304, "
+        f"{site_stats.get('responses/503', 0)} x 503, "
+        f"{site_stats.get('responses/404', 0)} x 404"
+    )
+    print(
+        f"  api:  {uploads} documents created "
+        f"({api_stats.get('documents/requests', 0)} single, "
+        f"{api_stats.get('documents/bulk_requests', 0)} bulk requests), "
+        f"{api_stats.get('documents/duplicates', 0)} duplicates, "
+        f"{api_stats.get('addon_events/stores', 0)} event data stores, "
+        f"{api_stats.get('files/uploads', 0)} run files uploads, "
+        f"{api_stats.get('responses/503', 0)} x 503, "
+        f"{api_stats.get('responses/504', 0)} x 504"
+    )
+    print(f"  upload throughput: {uploads / elapsed:.2f} documents/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[1:]),
+    )
+    parser.add_argument("--from-year", type=int, default=2024)
+    parser.add_argument("--to-year", type=int, default=2024)
+    parser.add_argument("--upload-limit", type=int, default=0)
+    parser.add_argument("--time-limit", type=int, default=0, help="Minutes")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--shard-by", choices=["years", "categories"], default="years")
+    parser.add_argument(
+        "--set",
+        type=setting,
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Scraper setting (JSON value)",
+    )
+    parser.add_argument("--keep", action="store_true", help="Keep the run files")
+    replay.add_arguments(parser)
+    args = parser.parse_args()
+
+    site, api = replay.start_servers(args)
+    work_dir = tempfile.mkdtemp(prefix="igedd-loadtest-")
+    shutil.copy(os.path.join(ROOT_DIR, "config.yaml"), work_dir)
+
+    try:
+        for run_number in range(1, args.runs + 1):
+            site_before, api_before = get_stats(site), get_stats(api)
+
+            elapsed = run_addon(args, site, api, run_number, work_dir)
+
+            report(
+                run_number,
+                elapsed,
+                stats_delta(site_before, get_stats(site)),
+                stats_delta(api_before, get_stats(api)),
+            )
+    finally:
+        if args.keep:
+            print(f"Run files: {work_dir}")
+        else:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
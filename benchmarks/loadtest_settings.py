@@ -0,0 +1,9 @@
+"""Settings of the load tests: the scraper settings, with the overrides passed
+by benchmarks/loadtest.py in the LOADTEST_SETTINGS environment variable (JSON)."""
+
+import json
+import os
+
+from scraper.settings import *  # noqa: F401, F403
+
+globals().update(json.loads(os.environ.get("LOADTEST_SETTINGS", "{}")))
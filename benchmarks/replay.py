@@ -0,0 +1,406 @@
+"""Local replay of the IGEDD site and fake DocumentCloud API, for load tests.
+
+The site server serves either a recorded site tree (--site DIR, where the path
+of each URL is a file of DIR) or the synthetic pages of benchmarks/fixtures.
+Documents (IMG/...) are generated on the fly, with a Last-Modified header
+derived from their path. Pages answer conditional GETs (If-Modified-Since)
+with 304s. Each response can be delayed (--latency) and a
+fraction of them replaced by 503 errors (--error-rate).
+
+The API server stands in for the DocumentCloud endpoints used by the add-on:
+users/me, projects, documents (single and bulk creation, search by source file
+URL), addon_runs (messages, progress, file uploads), addon_events (event data
+scratch) and messages. A fraction of the bulk requests can fail after creating
+their documents (--api-bulk-error-rate), as with a gateway timeout, and
+documents are only found by searches --api-index-delay seconds after their
+creation. Documents created twice (same source file URL) are counted.
+
+Both servers count the requests they receive, available as JSON on /_stats.
+
+Usage: python benchmarks/replay.py [--port 8765] [--api-port 8766] [options]
+"""
+
+import argparse
+import datetime
+import email.utils
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+# Path of the synthetic pages on the site
+FIXTURE_ROUTES = {
+    "/l-autorite-environnementale-r145.html": "home.html",
+    "/les-saisines-r417.html": "les-saisines.html",
+    "/les-saisines-de-l-autorite-environnementale-du-a417.html": "saisines.html",
+    "/avis-rendus-en-2024-r708.html": "avis-rendus-en-2024.html",
+    "/archives-des-avis-rendus-r470.html": "archives-des-avis-rendus.html",
+    "/2024-r708.html": "avis-2024.html",
+    "/decisions-de-cas-par-cas-sur-des-projets-r506.html": "cas-par-cas-projets.html",
+    "/decisions-de-cas-par-cas-sur-des-plans-programmes-r507.html": (
+        "cas-par-cas-plans.html"
+    ),
+    "/2024-en-cours-d-examen-et-decisions-rendues-r755.html": (
+        "cas-par-cas-projets-2024.html"
+    ),
+    "/2024-en-cours-d-examen-et-decisions-rendues-r750.html": (
+        "cas-par-cas-plans-2024.html"
+    ),
+}
+
+START_PATH = "/l-autorite-environnementale-r145.html"
+
+# Smallest valid PDF, served for every document
+PDF = (
+    b"%PDF-1.1\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+    b"2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n"
+    b"3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>endobj\n"
+    b"trailer<</Root 1 0 R>>\n%%EOF\n"
+)
+
+
+def last_modified(path):
+    """Returns a Last-Modified date for a document, stable between runs."""
+
+    digest = int(hashlib.sha256(path.encode()).hexdigest(), 16)
+    timestamp = 1704067200 + digest % (365 * 86400)  # during 2024
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """Threaded HTTP server with a latency, an error rate and request counts."""
+
+    daemon_threads = True
+
+    def __init__(self, address, handler, latency=0, error_rate=0, seed=0):
+        super().__init__(address, handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = Counter()
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def should_fail(self, rate=None):
+        with self.lock:
+            return self.random.random() < (self.error_rate if rate is None else rate)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers=None, head=False):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def send_json(self, data, status=200):
+        self.send_body(status, json.dumps(data).encode(), "application/json")
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(body) if body else None
+        except ValueError:
+            return None
+
+    def handle_request(self, method):
+        path = urlparse(self.path).path
+
+        if path == "/_stats":
+            self.send_json(dict(self.server.counts))
+            return
+
+        self.server.count(f"requests/{method}")
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        if self.server.should_fail():
+            self.server.count("responses/503")
+            self.send_body(
+                503, b"Service Unavailable", "text/plain", head=method == "HEAD"
+            )
+            return
+
+        self.route(method, path)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+
+class SiteHandler(Handler):
+    """Serves the IGEDD site."""
+
+    site_dir = None
+
+    def route(self, method, path):
+        head = method == "HEAD"
+
+        if "/IMG/" in path:
+            self.server.count("documents")
+            self.send_body(
+                200,
+                PDF,
+                "application/pdf",
+                {"Last-Modified": last_modified(path)},
+                head=head,
+            )
+            return
+
+        if self.site_dir:
+            file_path = os.path.join(self.site_dir, path.lstrip("/") or "index.html")
+        elif path in FIXTURE_ROUTES:
+            file_path = os.path.join(FIXTURES_DIR, FIXTURE_ROUTES[path])
+        else:
+            file_path = None
+
+        if not file_path or not os.path.isfile(file_path):
+            self.server.count("responses/404")
+            self.send_body(404, b"Not Found", "text/plain", head=head)
+            return
+
+        mtime = int(os.path.getmtime(file_path))
+        since = self.headers.get("If-Modified-Since")
+        if since and email.utils.parsedate_to_datetime(since).timestamp() >= mtime:
+            self.server.count("responses/304")
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        with open(file_path, "rb") as file:
+            body = file.read()
+
+        self.server.count("pages")
+        self.send_body(
+            200,
+            body,
+            "text/html; charset=utf-8",
+            {"Last-Modified": email.utils.formatdate(mtime, usegmt=True)},
+            head=head,
+        )
+
+
+class APIHandler(Handler):
+    """Stands in for the DocumentCloud API (under /api/)."""
+
+    def route(self, method, path):
+        parts = [part for part in path.split("/") if part]
+        if parts[:1] == ["api"]:
+            parts = parts[1:]
+        data = self.read_json() if method in ("POST", "PATCH", "PUT") else None
+        server = self.server
+
+        if parts == ["users", "me"]:
+            self.send_json(
+                {"id": 1, "username": "loadtest", "verified_journalist": True}
+            )
+
+        elif parts == ["projects"] and method == "GET":
+            self.send_json({"count": 0, "next": None, "results": []})
+
+        elif parts == ["projects"] and method == "POST":
+            self.send_json({"id": 1, "title": (data or {}).get("title")}, status=201)
+
+        elif parts == ["documents", "search"] and method == "GET":
+            query = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+            urls = set(re.findall(r'data_source_file_url:"([^"]*)"', query))
+            with server.lock:
+                results = [
+                    {
+                        **document,
+                        "data": {
+                            key: [value]
+                            for key, value in (document.get("data") or {}).items()
+                        },
+                    }
+                    for url, document in server.documents.items()
+                    if url in urls and server.indexed_at[url] <= time.time()
+                ]
+            self.send_json(
+                {
+                    "count": len(results),
+                    "next": None,
+                    "previous": None,
+                    "results": results,
+                }
+            )
+
+        elif parts == ["documents"] and method == "POST":
+            documents = data if isinstance(data, list) else [data]
+            with server.lock:
+                first_id = server.counts["documents/created"] + 1
+                server.counts["documents/created"] += len(documents)
+            server.count(
+                "documents/bulk_requests"
+                if isinstance(data, list)
+                else "documents/requests"
+            )
+            now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            created = [
+                {
+                    **(document or {}),
+                    "id": first_id + index,
+                    "status": "pending",
+                    "created_at": now,
+                    "updated_at": now,
+                }
+                for index, document in enumerate(documents)
+            ]
+            with server.lock:
+                for document in created:
+                    url = (document.get("data") or {}).get("source_file_url")
+                    if url in server.documents:
+                        server.counts["documents/duplicates"] += 1
+                    server.documents[url] = document
+                    server.indexed_at[url] = time.time() + server.index_delay
+            if isinstance(data, list) and server.should_fail(server.bulk_error_rate):
+                server.count("responses/504")
+                self.send_body(504, b"Gateway Timeout", "text/plain")
+                return
+            self.send_json(created if isinstance(data, list) else created[0], 201)
+
+        elif parts[:1] == ["addon_runs"] and method == "GET":
+            file_name = parse_qs(urlparse(self.path).query).get("upload_file", [""])[0]
+            self.send_json({"presigned_url": f"{server.url}/files/{file_name}"})
+
+        elif parts[:1] == ["addon_runs"]:
+            server.count("addon_runs/updates")
+            self.send_json({"uuid": parts[1] if len(parts) > 1 else None})
+
+        elif parts[:1] == ["files"] and method == "PUT":
+            server.count("files/uploads")
+            self.send_body(200, b"", "text/plain")
+
+        elif parts[:1] == ["addon_events"] and method == "GET":
+            self.send_json({"id": parts[1], "scratch": server.scratch})
+
+        elif parts[:1] == ["addon_events"] and method == "PATCH":
+            with server.lock:
+                server.scratch = (data or {}).get("scratch")
+            server.count("addon_events/stores")
+            self.send_json({"id": parts[1]})
+
+        elif parts == ["messages"]:
+            server.count("messages")
+            self.send_json({"id": 1}, 201)
+
+        else:
+            server.count("responses/404")
+            self.send_json({"detail": "Not found."}, 404)
+
+
+def start_server(handler, port, **kwargs):
+    """Starts a server in a background thread and returns it."""
+
+    server = ReplayServer(("127.0.0.1", port), handler, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def start_site(port=0, site_dir=None, **kwargs):
+    handler = type("SiteHandler", (SiteHandler,), {"site_dir": site_dir})
+    return start_server(handler, port, **kwargs)
+
+
+def start_api(port=0, scratch=None, bulk_error_rate=0, index_delay=0, **kwargs):
+    server = start_server(APIHandler, port, **kwargs)
+    server.scratch = scratch
+    server.bulk_error_rate = bulk_error_rate
+    server.index_delay = index_delay
+    # Source file URL -> documents created, and time they are found by searches
+    server.documents = {}
+    server.indexed_at = {}
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument("--site", help="Recorded site tree (default: fixtures)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--api-latency", type=float, default=0.1, help="Seconds")
+    parser.add_argument("--api-error-rate", type=float, default=0.0)
+    parser.add_argument("--api-bulk-error-rate", type=float, default=0.0)
+    parser.add_argument("--api-index-delay", type=float, default=0.0, help="Seconds")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def start_servers(args, port=0, api_port=0):
+    site = start_site(
+        port,
+        site_dir=args.site,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    api = start_api(
+        api_port,
+        latency=args.api_latency,
+        error_rate=args.api_error_rate,
+        bulk_error_rate=args.api_bulk_error_rate,
+        index_delay=args.api_index_delay,
+        seed=args.seed,
+    )
+    return site, api
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--api-port", type=int, default=8766)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    site, api = start_servers(args, args.port, args.api_port)
+
+    print(f"Site: {site.url}{START_PATH}")
+    print(f"API:  {api.url}/api/")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,11 @@ Disclose's custom scraper add-on for DocumentCloud.
 """
 
 import datetime
+import json
+import multiprocessing
 import os
 import sys
+import zipfile
 from urllib.parse import urlparse
 import logging
 
@@ -13,11 +16,44 @@ from documentcloud.addon import AddOn
 
 import scrapy
 from scrapy.crawler import CrawlerProcess
+from scrapy.utils.log import configure_logging
 from scrapy.utils.project import get_project_settings
 
 from scraper import settings as scraper_settings
+from scraper.extensions import RunMetrics
+from scraper.instrumentation import format_pipeline_stats
+from scraper.persistence import STATE_KEY
+from scraper.pipelines import MailPipeline, quiet_client_loggers
+from scraper.sharding import (
+    SharedCounter,
+    UploadRateLimiter,
+    make_shards,
+    merge_event_data,
+    merge_metrics,
+    merge_reports,
+    merge_scraper_states,
+    merge_stats,
+    partition_event_data,
+    shard_state,
+)
 from scraper.spiders.igedd import IGEDDSpider
 
+# Working directories of the shards of a sharded run
+SHARDS_DIR = "shards"
+
+# Event data and scraper state of a shard, its crawler stats and mail report
+SHARD_RESULT_PATH = "shard_event_data.json"
+SHARD_STATS_PATH = "shard_stats.json"
+SHARD_REPORT_PATH = "shard_report.json"
+
+
+def write_json(path, data):
+    """Writes a JSON file atomically."""
+
+    with open(path + ".tmp", "w") as file:
+        json.dump(data, file, default=str)
+    os.replace(path + ".tmp", path)
+
 
 class DiscloseIGEDDScraper(AddOn):
     """Scraper for MRAe documents (https://www.mrae.developpement-durable.gouv.fr)."""
@@ -121,44 +157,303 @@ class DiscloseIGEDDScraper(AddOn):
         else:
             self.project = ""
 
-        # Event data
+        # Sharded run: number of processes, splitting the years or categories
+        self.shards = self.data.get("shards", 1)
+        self.shard_by = self.data.get("shard_by", "years")
+
+        # Run
+
+        if len(self.target_years) == 1:
+            year_range_str = str(self.target_years[0])
+        else:
+            year_range_str = f"{str(self.target_years[0])}-{str(self.target_years[-1])}"
+
+        self.set_message(f"Scraping IGEDD documents {year_range_str} [{self.run_name}]")
+
+        if self.shards > 1:
+            self.crawl_shards()
+        else:
+            crawler = self.crawl(self.target_years)
+            self.upload_run_files(crawler.spider.run_files)
+
+        self.set_message("Scraping complete!")
+
+    def crawl(self, target_years, settings=None, **kwargs):
+        """Runs the spider (blocking), and returns its crawler."""
 
         # Load scraper settings and create process
 
         os.environ.setdefault("SCRAPY_SETTINGS_MODULE", scraper_settings.__name__)
-        process = CrawlerProcess(get_project_settings())
+        project_settings = get_project_settings()
+        project_settings.update(settings or {})
+        process = CrawlerProcess(project_settings)
 
         # Launch scraper
 
+        crawler = process.create_crawler(IGEDDSpider)
         process.crawl(
-            IGEDDSpider,
-            target_years=self.target_years,
-            upload_limit=self.upload_limit,
-            time_limit=self.time_limit,
-            client=self.client,
-            target_project=self.project,
-            access_level=self.access_level,
-            dry_run=self.dry_run,
-            run_id=self.id,
-            run_name=self.run_name,
-            send_mail=self.send_mail,
-            load_event_data=self.load_event_data,
-            store_event_data=self.store_event_data,
-            upload_file=self.upload_file,
-            upload_event_data=self.upload_event_data,
+            crawler,
+            **{
+                "target_years": target_years,
+                "upload_limit": self.upload_limit,
+                "time_limit": self.time_limit,
+                "client": self.client,
+                "target_project": self.project,
+                "access_level": self.access_level,
+                "dry_run": self.dry_run,
+                "run_id": self.id,
+                "run_name": self.run_name,
+                "send_mail": self.send_mail,
+                "load_event_data": self.load_event_data,
+                "store_event_data": self.store_event_data,
+                "upload_event_data": self.upload_event_data,
+                **kwargs,
+            },
         )
 
-        # Run
+        process.start()
+        return crawler
 
-        if len(self.target_years) == 1:
-            year_range_str = str(self.target_years[0])
+    def upload_run_files(self, run_files):
+        """Uploads the files of the run (report, event data, metrics) to the
+        add-on run, in a single zip archive as a run only keeps the last file
+        uploaded, then deletes the temporary ones."""
+
+        if not run_files:
+            return
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M")
+        archive_path = f"IGEDD_{timestamp}.zip"
+
+        with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for run_file in run_files:
+                archive.write(run_file["path"], os.path.basename(run_file["path"]))
+
+        with open(archive_path, "rb") as file:
+            self.upload_file(file)
+        logging.info(
+            f"Uploaded {len(run_files)} run files to the Documentcloud interface."
+        )
+
+        os.remove(archive_path)
+        for run_file in run_files:
+            if run_file["temporary"]:
+                os.remove(run_file["path"])
+
+    def crawl_shards(self):
+        """Runs the shards of the run in parallel processes (each one with its
+        own reactor), then merges their event data, metrics and mail reports.
+
+        Event data is loaded once and partitioned between the shards by target
+        year. The shards store their event data in their working directory
+        (shards/<n>/), and it is merged and stored on DocumentCloud once they
+        are done. The upload limit and UPLOAD_RATE_LIMIT apply to all the shards.
+        Dry runs keep the local event data of each shard in its directory.
+        """
+
+        os.environ.setdefault("SCRAPY_SETTINGS_MODULE", scraper_settings.__name__)
+        settings = get_project_settings()
+        configure_logging(settings)
+
+        # Forked processes share the upload rate limit and upload count
+        context = multiprocessing.get_context("fork")
+        upload_rate_limit = settings.getfloat("UPLOAD_RATE_LIMIT")
+        rate_limiter = (
+            UploadRateLimiter(upload_rate_limit, context) if upload_rate_limit else None
+        )
+        upload_counter = SharedCounter(context)
+
+        shards = make_shards(self.target_years, self.shards, self.shard_by)
+
+        remote = not self.dry_run and self.id
+        event_data = (self.load_event_data() or {}) if remote else {}
+        state = event_data.pop(STATE_KEY, {})
+
+        processes = []
+        for index, shard in enumerate(shards):
+            shard_dir = os.path.join(SHARDS_DIR, str(index))
+            os.makedirs(shard_dir, exist_ok=True)
+
+            shard_data = {
+                **partition_event_data(event_data, shard),
+                STATE_KEY: shard_state(state, shard),
+            }
+            process = context.Process(
+                target=self.crawl_shard,
+                args=(shard, shard_dir, shard_data, rate_limiter, upload_counter),
+                name=f"shard {shard['name']}",
+            )
+            process.start()
+            processes.append((process, shard_dir, shard_data))
+
+        shard_event_data = []
+        shard_stats = []
+        for (process, shard_dir, shard_data), shard in zip(processes, shards):
+            process.join()
+            if process.exitcode:
+                logging.warning(
+                    f"Shard {shard['name']} failed (exit code {process.exitcode})"
+                )
+
+            # The event data stored last by the shard, if any
+            try:
+                with open(os.path.join(shard_dir, SHARD_RESULT_PATH)) as file:
+                    shard_event_data.append(json.load(file))
+            except (OSError, ValueError):
+                shard_event_data.append(shard_data)
+
+            try:
+                with open(os.path.join(shard_dir, SHARD_STATS_PATH)) as file:
+                    shard_stats.append(json.load(file))
+            except (OSError, ValueError):
+                shard_stats.append({})
+
+        stats = merge_stats(shard_stats)
+        logging.info(
+            f"{len(shards)} shards done: "
+            f"{stats.get('item_scraped_count', 0)} documents scraped, "
+            f"{stats.get('item_dropped_count', 0)} dropped, "
+            f"{stats.get('log_count/ERROR', 0)} errors"
+        )
+
+        run_files = []
+
+        self.send_shard_reports(settings, shards, stats, run_files)
+
+        if remote:
+            quiet_client_loggers()
+            merged = merge_event_data(event_data, shard_event_data)
+            merged[STATE_KEY] = merge_scraper_states(
+                state, shards, [data.get(STATE_KEY, {}) for data in shard_event_data]
+            )
+            self.store_event_data(merged)
+            logging.info(f"Event data up to date ({len(merged) - 1} documents)")
+
+            if self.upload_event_data:
+                timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M")
+                path = f"event_data_IGEDD_{timestamp}.json"
+                with open(path, "w") as file:
+                    json.dump(merged, file)
+                run_files.append({"path": path, "temporary": True})
+
+        if settings.getbool("RUN_METRICS_ENABLED"):
+            metrics_path = self.merge_shard_metrics(settings, shards)
+            if (
+                metrics_path
+                and settings.getbool("RUN_METRICS_UPLOAD")
+                and not self.dry_run
+                and self.id
+            ):
+                run_files.append({"path": metrics_path, "temporary": False})
+
+        self.upload_run_files(run_files)
+
+    def crawl_shard(self, shard, shard_dir, event_data, rate_limiter, upload_counter):
+        """Runs a shard (in its own process)."""
+
+        os.chdir(shard_dir)
+
+        # Do not reuse the connections of the parent process
+        self.client.session.close()
+
+        def store_event_data(data):
+            write_json(SHARD_RESULT_PATH, data)
+
+        crawler = self.crawl(
+            shard["target_years"],
+            settings={
+                "RUN_METRICS_UPLOAD": False,
+                "MAIL_REPORT_PATH": SHARD_REPORT_PATH,
+            },
+            categories=shard["categories"],
+            load_event_data=lambda: event_data,
+            store_event_data=store_event_data,
+            upload_event_data=False,
+            upload_rate_limiter=rate_limiter,
+            upload_counter=upload_counter,
+        )
+
+        write_json(SHARD_STATS_PATH, crawler.stats.get_stats())
+
+    def send_shard_reports(self, settings, shards, stats, run_files):
+        """Merges the mail reports of the shards, written in their directories,
+        and sends the mail of the run, with the pipeline stats found in the
+        merged stats of the shards (adding the complete list to run_files)."""
+
+        reports = []
+        for index in range(len(shards)):
+            shard_dir = os.path.join(SHARDS_DIR, str(index))
+            try:
+                with open(os.path.join(shard_dir, SHARD_REPORT_PATH)) as file:
+                    report = json.load(file)
+            except (OSError, ValueError):
+                logging.warning(f"No mail report for shard {shards[index]['name']}")
+                continue
+            report["list_path"] = os.path.join(shard_dir, report["list_path"])
+            reports.append(report)
+
+        if not reports:
+            return
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M")
+        report = merge_reports(
+            reports,
+            f"report_IGEDD_{timestamp}.csv.gz",
+            settings.getint("MAIL_REPORT_MAX_ITEMS"),
+        )
+        for shard_report in reports:
+            os.remove(shard_report["list_path"])
+
+        # Uploaded with the other run files of an add-on run, deleted otherwise
+        if (
+            not self.dry_run
+            and self.id
+            and report["count_ok"] + report["count_with_error"]
+        ):
+            run_files.append({"path": report["list_path"], "temporary": True})
         else:
-            year_range_str = f"{str(self.target_years[0])}-{str(self.target_years[-1])}"
+            os.remove(report["list_path"])
+
+        if self.dry_run:
+            return
+
+        subject, content = MailPipeline.mail(
+            report,
+            self.target_years,
+            self.run_name,
+            self.id,
+            self.dry_run,
+            format_pipeline_stats(stats),
+        )
+        self.send_mail(subject, content)
 
-        self.set_message(f"Scraping IGEDD documents {year_range_str} [{self.run_name}]")
+    def merge_shard_metrics(self, settings, shards):
+        """Merges the run metrics of the shards, written in their directories.
+        Returns the path of the merged metrics, if any."""
 
-        process.start()
-        self.set_message("Scraping complete!")
+        path = settings.get("RUN_METRICS_PATH")
+
+        shard_metrics = []
+        for index in range(len(shards)):
+            try:
+                with open(os.path.join(SHARDS_DIR, str(index), path)) as file:
+                    shard_metrics.append(json.load(file))
+            except (OSError, ValueError):
+                logging.warning(f"No run metrics for shard {shards[index]['name']}")
+
+        if not shard_metrics:
+            return None
+
+        metrics = merge_metrics(shard_metrics)
+
+        with open(path, "w") as metrics_file:
+            json.dump(metrics, metrics_file, indent=2)
+
+        prometheus_path = settings.get("RUN_METRICS_PROMETHEUS_PATH")
+        if prometheus_path:
+            RunMetrics.write_prometheus(prometheus_path, metrics)
+
+        return path
 
 
 if __name__ == "__main__":
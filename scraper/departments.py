@@ -180,6 +180,46 @@ REGIONS = {
 }
 
 
+def names_regex(pattern, names):
+    """Compile a single regex matching any of the names, as group 1 of pattern."""
+
+    alternatives = "|".join(re.escape(name) for name in names)
+    return re.compile(pattern.format(names=f"({alternatives})"), re.IGNORECASE)
+
+
+def lookup_name(codes, name):
+    """Returns the codes of a name matched by a names_regex."""
+
+    try:
+        return codes[name.lower()]
+    except KeyError:
+        # Characters matched case-insensitively by re but not by lower()
+        for key in codes:
+            if re.fullmatch(re.escape(key), name, re.IGNORECASE):
+                return codes[key]
+
+
+# Compiled once: departments_from_project_name runs for every item.
+# Names are matched case-insensitively, then looked up in lowercase.
+
+DEPARTMENT_CODES = {dept.lower(): code for dept, code in DEPARTMENTS.items()}
+DEPARTMENT_CODES_NO_HYPHENS = {
+    dept.replace("-", " ").lower(): code for dept, code in DEPARTMENTS.items()
+}
+REGION_CODES = {}
+for reg, codes in REGIONS.items():
+    REGION_CODES[reg.lower()] = codes
+    REGION_CODES[reg.replace("-", " ").lower()] = codes
+
+# "(Haute-Loire)" anywhere, or "(Haute Loire)" at the end of the project name
+DEPARTMENT_NAMES_REGEX = names_regex(r"\({names}\)", DEPARTMENT_CODES)
+DEPARTMENT_NAMES_AT_END_REGEX = names_regex(
+    r"\({names}\)$", DEPARTMENT_CODES_NO_HYPHENS
+)
+# "région Grand Est" (no region name is a prefix of another one)
+REGION_NAMES_REGEX = names_regex(r"\brégion {names}\b", REGION_CODES)
+
+
 def department_from_authority(authority):
     """Match department from authority field. Returns 1 dept code as string or an empty string."""
 
@@ -218,30 +258,36 @@ def departments_from_project_name(project_name):
 
     # By department name in parentheses
     if not departments:
-        for dept in DEPARTMENTS:
-            # escaped_dept = dept = dept.replace("'", "'")
-            dept_no_hyphens = dept.replace("-", " ")
+        for match in DEPARTMENT_NAMES_REGEX.finditer(project_name):
+            departments.append(lookup_name(DEPARTMENT_CODES, match.group(1)))
 
-            if re.search(rf"\({dept}\)", project_name, re.IGNORECASE) or re.search(
-                rf"\({dept_no_hyphens}\)$", project_name, re.IGNORECASE
-            ):
-                departments.append(DEPARTMENTS[dept])
+        match = DEPARTMENT_NAMES_AT_END_REGEX.search(project_name)
+        if match:
+            departments.append(lookup_name(DEPARTMENT_CODES_NO_HYPHENS, match.group(1)))
 
     # By Region name
     if not departments:
-        for reg in REGIONS:
-            # escaped_region = reg.replace("'", "'")
-            reg_no_hyphens = reg.replace("-", " ")
-
-            if re.search(
-                rf"\brégion {reg}\b", project_name, re.IGNORECASE
-            ) or re.search(
-                rf"\brégion {reg_no_hyphens}\b", project_name, re.IGNORECASE
-            ):
-                for d in REGIONS[reg]:
-                    departments.append(d)
+        for match in REGION_NAMES_REGEX.finditer(project_name):
+            departments.extend(lookup_name(REGION_CODES, match.group(1)))
 
     # Remove duplicates & order
     departments = sorted(list(set(departments)))
 
     return departments
+
+
+def departments_tags(authority, project):
+    """Departments of a document (from its authority, else from its project
+    name) and their sources, as tuples."""
+
+    authority_department = department_from_authority(authority)
+
+    if authority_department:
+        return ("authority",), (authority_department,)
+
+    project_departments = departments_from_project_name(project)
+
+    if project_departments:
+        return ("regex",), tuple(project_departments)
+
+    return (), ()
@@ -0,0 +1,308 @@
+# Define here the extensions of the scraper
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+import datetime
+import json
+import os
+import time
+from collections import Counter
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from twisted.internet import task
+
+from .signals import document_uploaded
+
+
+def label_value(value):
+    """Escape a Prometheus label value."""
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Upper bounds (seconds) of the upload latency histogram buckets
+UPLOAD_LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class RunMetrics:
+    """Export machine-readable metrics of the run.
+
+    Writes a JSON file (RUN_METRICS_PATH) when the spider closes and, if
+    RUN_METRICS_PROMETHEUS_PATH is set, a Prometheus textfile (for the node
+    exporter textfile collector). With RUN_METRICS_UPLOAD, the JSON file is
+    added to the archive of the run files, uploaded to the add-on run at the
+    end of the run.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("RUN_METRICS_ENABLED"):
+            raise NotConfigured
+
+        ext = cls()
+        ext.crawler = crawler
+        ext.stats = crawler.stats
+        ext.settings = crawler.settings
+
+        ext.pages_fetched = 0
+        ext.drop_reasons = Counter()
+        ext.error_reasons = Counter()
+        ext.upload_latencies = []
+        ext.download_delays = []
+
+        ext.start_time = time.monotonic()
+        ext.sample_loop = task.LoopingCall(ext.sample_download_delays)
+
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        crawler.signals.connect(ext.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(ext.item_error, signal=signals.item_error)
+        crawler.signals.connect(ext.document_uploaded, signal=document_uploaded)
+        return ext
+
+    def spider_opened(self, spider):
+        self.start_time = time.monotonic()
+        self.sample_loop.start(self.settings.getint("RUN_METRICS_SAMPLE_INTERVAL"))
+
+    def response_received(self, response, request, spider):
+        # Documents are only requested with HEAD (or yielded from a data: URL)
+        if request.method == "GET" and not request.url.startswith("data:"):
+            self.pages_fetched += 1
+
+    def item_dropped(self, item, response, exception, spider):
+        self.drop_reasons[str(exception) or type(exception).__name__] += 1
+
+    def item_error(self, item, response, spider, failure):
+        self.error_reasons[str(failure.value) or failure.type.__name__] += 1
+
+    def document_uploaded(self, item, latency):
+        self.upload_latencies.append(latency)
+
+    def sample_download_delays(self):
+        """Record the delay of each download slot (adjusted by AutoThrottle)."""
+
+        engine = self.crawler.engine
+        if not engine or not engine.downloader:
+            return
+
+        self.download_delays.append(
+            {
+                "elapsed": round(time.monotonic() - self.start_time, 1),
+                "delays": {
+                    key: round(slot.delay, 3)
+                    for key, slot in engine.downloader.slots.items()
+                },
+            }
+        )
+
+    def upload_latency_histogram(self):
+        """Cumulative histogram of the upload latencies, Prometheus-style."""
+
+        buckets = {}
+        for bound in UPLOAD_LATENCY_BUCKETS:
+            buckets[str(bound)] = sum(1 for x in self.upload_latencies if x <= bound)
+        buckets["+Inf"] = len(self.upload_latencies)
+
+        return {
+            "buckets": buckets,
+            "sum": round(sum(self.upload_latencies), 3),
+            "count": len(self.upload_latencies),
+        }
+
+    def metrics(self, spider, reason):
+        elapsed = time.monotonic() - self.start_time
+        uploads = len(self.upload_latencies)
+        stats = self.stats.get_stats()
+
+        return {
+            "run_id": spider.run_id,
+            "run_name": spider.run_name,
+            "dry_run": bool(spider.dry_run),
+            "target_years": [spider.target_years[0], spider.target_years[-1]],
+            "finished_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "elapsed_seconds": round(elapsed, 1),
+            "close_reason": reason,
+            "listing_pages_fetched": self.pages_fetched,
+            "listing_pages_not_modified": stats.get("conditional_get/not_modified", 0),
+            "listing_pages_unchanged": stats.get(
+                "fingerprint/pages_short_circuited", 0
+            ),
+            "response_bytes": stats.get("downloader/response_bytes", 0),
+            "head_requests": stats.get("downloader/request_method_count/HEAD", 0),
+            "head_requests_avoided": stats.get("head/avoided", 0)
+            + stats.get("head_cache/hit", 0),
+            "head_requests_failed": stats.get("head/failed", 0),
+            "documents_already_seen": stats.get("documents/already_seen", 0),
+            "documents_duplicate_candidates": stats.get(
+                "documents/duplicate_candidates", 0
+            ),
+            "items_scraped": stats.get("item_scraped_count", 0),
+            "items_dropped": dict(self.drop_reasons),
+            "item_errors": dict(self.error_reasons),
+            "uploads": uploads,
+            "uploads_per_minute": round(uploads / elapsed * 60, 2) if elapsed else 0,
+            "upload_latency_seconds": self.upload_latency_histogram(),
+            "download_delays": self.download_delays,
+        }
+
+    @staticmethod
+    def prometheus(metrics):
+        """Returns the metrics in the Prometheus text format."""
+
+        labels = f'run_name="{label_value(metrics["run_name"])}"'
+        lines = []
+
+        def gauge(name, value, description, extra_labels=""):
+            lines.append(f"# HELP igedd_scraper_{name} {description}")
+            lines.append(f"# TYPE igedd_scraper_{name} gauge")
+            lines.append(f"igedd_scraper_{name}{{{labels}{extra_labels}}} {value}")
+
+        gauge("run_seconds", metrics["elapsed_seconds"], "Duration of the run.")
+        gauge(
+            "listing_pages_fetched",
+            metrics["listing_pages_fetched"],
+            "Listing pages downloaded.",
+        )
+        gauge("response_bytes", metrics["response_bytes"], "Bytes downloaded.")
+        gauge("head_requests", metrics["head_requests"], "HEAD requests sent.")
+        gauge(
+            "documents_already_seen",
+            metrics["documents_already_seen"],
+            "Documents skipped because already in event data.",
+        )
+        gauge("uploads", metrics["uploads"], "Documents uploaded.")
+        gauge(
+            "closed",
+            1,
+            "Reason the spider closed.",
+            f',reason="{label_value(metrics["close_reason"])}"',
+        )
+
+        name = "igedd_scraper_items_dropped"
+        lines.append(f"# HELP {name} Items dropped, by reason.")
+        lines.append(f"# TYPE {name} gauge")
+        for reason, count in metrics["items_dropped"].items():
+            lines.append(f'{name}{{{labels},reason="{label_value(reason)}"}} {count}')
+
+        histogram = metrics["upload_latency_seconds"]
+        name = "igedd_scraper_upload_latency_seconds"
+        lines.append(f"# HELP {name} Latency of the document uploads.")
+        lines.append(f"# TYPE {name} histogram")
+        for bound, count in histogram["buckets"].items():
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f"{name}_sum{{{labels}}} {histogram['sum']}")
+        lines.append(f"{name}_count{{{labels}}} {histogram['count']}")
+
+        return "\n".join(lines) + "\n"
+
+    def spider_closed(self, spider, reason):
+        if self.sample_loop.running:
+            self.sample_loop.stop()
+        self.sample_download_delays()
+
+        metrics = self.metrics(spider, reason)
+
+        path = self.settings.get("RUN_METRICS_PATH")
+        with open(path, "w") as metrics_file:
+            json.dump(metrics, metrics_file, indent=2)
+        spider.logger.info(f"Saved run metrics to {path}")
+
+        if (
+            self.settings.getbool("RUN_METRICS_UPLOAD")
+            and not spider.dry_run
+            and spider.run_id
+        ):
+            spider.attach_run_file(path, temporary=False)
+
+        prometheus_path = self.settings.get("RUN_METRICS_PROMETHEUS_PATH")
+        if prometheus_path:
+            self.write_prometheus(prometheus_path, metrics)
+
+    @classmethod
+    def write_prometheus(cls, path, metrics):
+        # Written then renamed, as the textfile collector may read it anytime
+        with open(path + ".tmp", "w") as file:
+            file.write(cls.prometheus(metrics))
+        os.replace(path + ".tmp", path)
+
+
+class SlotAutoThrottle:
+    """AutoThrottle using the delay of each host in DOWNLOAD_SLOTS as its minimum.
+
+    Scrapy's AutoThrottle already adjusts the delay of each download slot (host)
+    separately, but never below the global DOWNLOAD_DELAY. This extension
+    replaces it, with the same AUTOTHROTTLE_* settings and delay policy, but
+    hosts listed in DOWNLOAD_SLOTS start from, and are kept above, their own
+    delay instead, so that the document hosts are not throttled like the
+    listing pages.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool("AUTOTHROTTLE_ENABLED"):
+            raise NotConfigured
+
+        self.crawler = crawler
+        self.debug = settings.getbool("AUTOTHROTTLE_DEBUG")
+        self.target_concurrency = settings.getfloat("AUTOTHROTTLE_TARGET_CONCURRENCY")
+        if self.target_concurrency <= 0:
+            raise NotConfigured("AUTOTHROTTLE_TARGET_CONCURRENCY must be higher than 0")
+        self.max_delay = settings.getfloat("AUTOTHROTTLE_MAX_DELAY")
+        self.slot_settings = settings.getdict("DOWNLOAD_SLOTS")
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(
+            self.response_downloaded, signal=signals.response_downloaded
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.default_min_delay = getattr(
+            spider, "download_delay", self.crawler.settings.getfloat("DOWNLOAD_DELAY")
+        )
+        # Start delay of the slots not in DOWNLOAD_SLOTS
+        spider.download_delay = max(
+            self.default_min_delay,
+            self.crawler.settings.getfloat("AUTOTHROTTLE_START_DELAY"),
+        )
+
+    def min_delay(self, key):
+        """Minimum delay of a download slot."""
+
+        return self.slot_settings.get(key, {}).get("delay", self.default_min_delay)
+
+    def response_downloaded(self, response, request, spider):
+        key = request.meta.get("download_slot")
+        latency = request.meta.get("download_latency")
+        slot = self.crawler.engine.downloader.slots.get(key) if key else None
+        if (
+            latency is None
+            or slot is None
+            or request.meta.get("autothrottle_dont_adjust_delay", False)
+        ):
+            return
+
+        # Send a request every latency / AUTOTHROTTLE_TARGET_CONCURRENCY seconds:
+        # move the delay halfway to that, or to that directly if it is higher
+        target_delay = latency / self.target_concurrency
+        new_delay = max(target_delay, (slot.delay + target_delay) / 2)
+        new_delay = min(max(self.min_delay(key), new_delay), self.max_delay)
+
+        # Error pages (and redirections) are usually small, and fast: they would
+        # lower the delay
+        if response.status != 200 and new_delay <= slot.delay:
+            return
+
+        if self.debug:
+            spider.logger.info(
+                f"slot: {key} | delay: {slot.delay * 1000:.0f} -> "
+                f"{new_delay * 1000:.0f} ms | latency: {latency * 1000:.0f} ms"
+            )
+        slot.delay = new_delay
@@ -0,0 +1,261 @@
+"""Extraction of the documents of a documents page, in one pass over its lxml
+tree (the tree parsed by Scrapy for the response).
+
+Returns plain records (dicts of DocumentItem fields, plus the date written on
+the listing page, if any) instead of items, so that the extraction does not
+depend on the spider.
+"""
+
+import re
+
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
+
+AUTHORITY = "IGEDD"
+
+_css = HTMLTranslator().css_to_xpath
+
+# Compiled once, instead of on each .css() call
+TITLE_XPATH = etree.XPath("//title/text()")
+CONTENT_XPATH = etree.XPath(_css("#contenu .contenu-article .texte-article > *"))
+DOWNLOAD_BOXES_XPATH = etree.XPath(_css("#main .texte-article .fr-download"))
+
+YEAR_REGEX = re.compile(r"20\d\d")
+PROJECT_REGEX = re.compile("Nom et formulaire du dossier\xa0: (.*)\n")
+
+
+def has_class(element, name):
+    return name in (element.get("class") or "").split()
+
+
+def elements(root):
+    """The elements of a subtree (root included), in document order."""
+
+    return root.iter(etree.Element)
+
+
+def own_texts(element):
+    """The text nodes directly under an element (`::text`)."""
+
+    if element.text is not None:
+        yield element.text
+    for child in element:
+        if child.tail is not None:
+            yield child.tail
+
+
+def first(iterable):
+    return next(iter(iterable), None)
+
+
+def extract_documents(response, category_local, target_years):
+    """Returns the records of the documents of a documents page."""
+
+    root = response.selector.root
+    page_url = response.request.url
+    page_title = first(TITLE_XPATH(root))
+
+    if category_local == "Avis rendus":
+        return extract_avis(response, root, page_url, page_title, target_years)
+    elif category_local.startswith("Décisions de cas par cas"):
+        return extract_cas_par_cas(response, root, page_url, page_title, category_local)
+    elif category_local == "Saisines":
+        return extract_saisines(response, root, page_url, target_years)
+    return []
+
+
+def content_elements(root):
+    """The blocks of the article of a page, each one with its h2 headings and its
+    framed boxes (.texteencadre-spip)."""
+
+    for element in CONTENT_XPATH(root):
+        headings = []
+        encadres = []
+        for descendant in elements(element):
+            if descendant.tag == "h2":
+                headings.append(descendant)
+            elif has_class(descendant, "texteencadre-spip"):
+                encadres.append(descendant)
+        yield headings, encadres
+
+
+def extract_avis(response, root, page_url, page_title, target_years):
+    """Avis rendus: a box per avis, under the date of the session."""
+
+    years = [str(y) for y in target_years if str(y) in page_title]
+
+    records = []
+    decision_date_string = None
+
+    for headings, encadres in content_elements(root):
+        if headings:
+            decision_date_line = first(
+                text for heading in headings for text in own_texts(heading)
+            )
+            decision_date_string = decision_date_line.replace("Séance du ", "")
+            continue
+
+        if not encadres:
+            continue
+
+        links = [
+            link
+            for encadre in encadres
+            for link in elements(encadre)
+            if link.tag == "a" and has_class(link, "fr-download__link")
+        ]
+        if not links:
+            continue
+
+        full_info = "".join(
+            text
+            for encadre in encadres
+            for text in encadre.itertext()
+            if text != "NOUVEAU"
+        )
+
+        project = first(
+            text
+            for encadre in encadres
+            for link in elements(encadre)
+            if has_class(link, "fr-download__link")
+            for text in link.itertext()
+        ).strip()
+
+        if "cadrage préalable" in project.lower():
+            title = "Cadrage préalable"
+        else:
+            title = "Avis"
+
+        for year in years:
+            records.append(
+                {
+                    "title": title,
+                    "project": project,
+                    "authority": AUTHORITY,
+                    "category_local": "Avis rendus",
+                    "source_file_url": response.urljoin(links[0].attrib["href"]),
+                    "source_page_url": page_url,
+                    "full_info": full_info,
+                    "year": year,
+                    "listing_date": decision_date_string,
+                }
+            )
+
+    return records
+
+
+def extract_cas_par_cas(response, root, page_url, page_title, category_local):
+    """Décisions de cas par cas: a box per dossier, with its form and the
+    decisions, recours, etc."""
+
+    page_year = YEAR_REGEX.search(page_title)[0]
+
+    records = []
+
+    def record(title, full_info, project, url):
+        return {
+            "title": title,
+            "category_local": category_local,
+            "authority": AUTHORITY,
+            "full_info": full_info,
+            "project": project,
+            "source_page_url": page_url,
+            "source_file_url": response.urljoin(url),
+            "year": page_year,
+        }
+
+    for headings, encadres in content_elements(root):
+        if headings or not encadres:
+            continue
+
+        full_info = "".join(text for encadre in encadres for text in encadre.itertext())
+
+        download_links = []
+        spip_links = []
+        for encadre in encadres:
+            for link in elements(encadre):
+                if link.tag != "a":
+                    continue
+                if has_class(link, "fr-download__link"):
+                    download_links.append(link)
+                if has_class(link, "spip_out"):
+                    spip_links.append(link)
+
+        # Project
+        project = first(text for link in spip_links for text in own_texts(link))
+        if project is not None:
+            project = project.strip()
+        else:
+            project_match = PROJECT_REGEX.search(full_info)
+            if project_match:
+                project = project_match.group(1).strip()
+            else:
+                project = "ERROR"
+
+        # links in boxes (avis, recours, lettres, etc)
+        for link in download_links:
+            link_text = first(link.itertext()).strip()
+            if link_text in ["OUI", "NON"]:
+                title = f"Décision ({link_text})"
+            else:
+                title = link_text
+            records.append(record(title, full_info, project, link.attrib["href"]))
+
+        # simple links (formulaire, recours)
+        for index, link in enumerate(spip_links):
+            if index == 0:
+                title = "Formulaire"
+            else:
+                title = first(link.itertext()).strip()
+            records.append(record(title, full_info, project, link.attrib["href"]))
+
+    return records
+
+
+def extract_saisines(response, root, page_url, target_years):
+    """Saisines: a download box per accusé de réception, after the paragraph
+    of the project and its date."""
+
+    records = []
+
+    for box in DOWNLOAD_BOXES_XPATH(root):
+        links = [
+            link
+            for link in elements(box)
+            if link.tag == "a" and has_class(link, "fr-download__link")
+        ]
+
+        doc_title = "".join(
+            text.strip() for link in links for text in own_texts(link) if text.strip()
+        )
+
+        # Nearest preceding p (not all of them, as `preceding-sibling::p`
+        # does, which is quadratic on the archive pages)
+        preceding_p = first(box.itersiblings("p", preceding=True))
+
+        project = first(
+            text
+            for strong in elements(preceding_p)
+            if strong.tag == "strong"
+            for text in strong.itertext()
+        )
+
+        date_string = list(preceding_p.itertext())[-1]
+        year = int(YEAR_REGEX.search(date_string).group())
+
+        if year in target_years:
+            records.append(
+                {
+                    "title": f"Accusé de reception - {doc_title}",
+                    "project": project,
+                    "authority": AUTHORITY,
+                    "category_local": "Saisines",
+                    "source_file_url": response.urljoin(links[0].attrib["href"]),
+                    "source_page_url": page_url,
+                    "year": str(year),
+                    "listing_date": date_string,
+                }
+            )
+
+    return records
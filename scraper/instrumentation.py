@@ -0,0 +1,146 @@
+"""Latency instrumentation of the item pipelines."""
+
+import inspect
+import math
+import time
+
+from scrapy.exceptions import DropItem
+
+# Prefix of the pipeline stats, e.g. "pipeline/UploadPipeline/p95_ms"
+STATS_PREFIX = "pipeline/"
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of a sorted list."""
+
+    index = max(math.ceil(fraction * len(sorted_values)) - 1, 0)
+    return sorted_values[index]
+
+
+def merge_pipeline_stats(shard_stats):
+    """Merges the pipeline stats of the shards of a sharded run.
+
+    Counts, drops and total latencies are summed, and the max latency is the
+    highest of the shards. The latencies themselves are not kept, so the p50
+    and p95 are approximated by the averages of the shards, weighted by their
+    counts.
+    """
+
+    merged = {}
+    for stats in shard_stats:
+        for key, value in stats.items():
+            if not key.startswith(STATS_PREFIX):
+                continue
+            name, stat = key[len(STATS_PREFIX) :].rsplit("/", 1)
+            count = stats.get(f"{STATS_PREFIX}{name}/count", 0)
+            if stat in ("p50_ms", "p95_ms"):
+                value *= count
+            if stat == "max_ms":
+                merged[key] = max(merged.get(key, 0), value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+    for key in merged:
+        if key.endswith(("/p50_ms", "/p95_ms")):
+            count = merged[key.rsplit("/", 1)[0] + "/count"]
+            merged[key] = round(merged[key] / count, 3) if count else 0
+
+    return merged
+
+
+def format_pipeline_stats(stats):
+    """Returns a table of the pipeline stats found in a stats dict, or an empty
+    string if the pipelines were not instrumented."""
+
+    names = []
+    for key in stats:
+        if key.startswith(STATS_PREFIX) and key.endswith("/count"):
+            names.append(key[len(STATS_PREFIX) : -len("/count")])
+
+    if not names:
+        return ""
+
+    lines = [
+        f"{'pipeline':<32} {'count':>7} {'total s':>9} {'p50 ms':>8} "
+        f"{'p95 ms':>8} {'max ms':>8} {'drops':>6}"
+    ]
+    for name in names:
+        values = {
+            stat: stats.get(f"{STATS_PREFIX}{name}/{stat}", 0)
+            for stat in ("count", "total_ms", "p50_ms", "p95_ms", "max_ms", "drops")
+        }
+        lines.append(
+            f"{name:<32} {values['count']:>7} {values['total_ms'] / 1000:>9.2f} "
+            f"{values['p50_ms']:>8.2f} {values['p95_ms']:>8.2f} "
+            f"{values['max_ms']:>8.2f} {values['drops']:>6}"
+        )
+
+    return "\n".join(lines)
+
+
+class PipelineStats:
+    """Latency of the process_item() of each pipeline.
+
+    Enabled by PIPELINE_STATS_ENABLED: the pipelines wrap their process_item()
+    with timed() when they are created (see SpiderPipeline). Records, for each
+    pipeline, the number of items processed and dropped, and the total, p50,
+    p95 and max latency, written in the crawler stats (pipeline/<name>/...) by
+    MailPipeline before it reports them.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.drops = {}
+
+    def timed(self, name, process_item):
+        """Wraps a process_item() method to record its latency."""
+
+        latencies = self.latencies.setdefault(name, [])
+        self.drops.setdefault(name, 0)
+
+        if inspect.iscoroutinefunction(process_item):
+
+            async def timed_process_item(item):
+                start = time.perf_counter()
+                try:
+                    return await process_item(item)
+                except DropItem:
+                    self.drops[name] += 1
+                    raise
+                finally:
+                    latencies.append(time.perf_counter() - start)
+
+        else:
+
+            def timed_process_item(item):
+                start = time.perf_counter()
+                try:
+                    return process_item(item)
+                except DropItem:
+                    self.drops[name] += 1
+                    raise
+                finally:
+                    latencies.append(time.perf_counter() - start)
+
+        return timed_process_item
+
+    def write(self, stats):
+        """Writes the pipeline stats in the crawler stats."""
+
+        for name, latencies in self.latencies.items():
+            prefix = f"{STATS_PREFIX}{name}/"
+            stats.set_value(prefix + "count", len(latencies))
+            stats.set_value(prefix + "drops", self.drops[name])
+
+            if not latencies:
+                continue
+
+            latencies = sorted(latencies)
+            stats.set_value(prefix + "total_ms", round(sum(latencies) * 1000, 3))
+            stats.set_value(
+                prefix + "p50_ms", round(percentile(latencies, 0.5) * 1000, 3)
+            )
+            stats.set_value(
+                prefix + "p95_ms", round(percentile(latencies, 0.95) * 1000, 3)
+            )
+            stats.set_value(prefix + "max_ms", round(latencies[-1] * 1000, 3))
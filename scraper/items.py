@@ -40,3 +40,68 @@ class DocumentItem(Item):
 
     departments = Field()
     departments_sources = Field()
+
+
+# Headers of the documents used by the scraper (publication date, size in the
+# HEAD cache), the only ones kept in compact mode
+DOCUMENT_HEADERS = ["Last-Modified", "Content-Length"]
+
+
+class DocumentRecord:
+    """Compact form of a DocumentItem, for the documents followed by the spider
+    until they are yielded as items (COMPACT_ITEMS).
+
+    Only has the fields set by the spider, in slots instead of the dict of an
+    item, so that the documents waiting for their HEAD request (or kept for the
+    checkpoint) take less memory.
+    """
+
+    __slots__ = [
+        "title",
+        "project",
+        "authority",
+        "category_local",
+        "source_file_url",
+        "source_page_url",
+        "full_info",
+        "year",
+        "publication_lastmodified",
+        "headers",
+    ]
+
+    def __init__(self, **fields):
+        for name, value in fields.items():
+            self[name] = value
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
+        try:
+            setattr(self, name, value)
+        except AttributeError:
+            raise KeyError(f"DocumentRecord does not support field: {name}") from None
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def item(self):
+        return DocumentItem(
+            **{
+                name: getattr(self, name)
+                for name in self.__slots__
+                if hasattr(self, name)
+            }
+        )
+
+
+def document_item(document):
+    """The item of a document followed by the spider (DocumentRecord or
+    DocumentItem)."""
+
+    if isinstance(document, DocumentRecord):
+        return document.item()
+    return document
@@ -4,10 +4,13 @@
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from .signals import page_completed
+
 
 class ScraperSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +104,74 @@ class ScraperDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class ConditionalGetMiddleware:
+    """Send conditional requests for documents pages and skip unmodified pages.
+
+    The validators (ETag, Last-Modified) of a documents page are kept in the
+    scraper state once all its new documents were processed, and sent with
+    If-None-Match / If-Modified-Since on the next runs. A 304 response means
+    that there are no new documents on the page, so it is not parsed.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("CONDITIONAL_GET_ENABLED"):
+            raise NotConfigured
+
+        m = cls()
+        m.crawler = crawler
+        m.stats = crawler.stats
+        # Validators of the pages downloaded during this run
+        m.validators = {}
+        crawler.signals.connect(m.page_completed, signal=page_completed)
+        return m
+
+    @property
+    def cache(self):
+        return self.crawler.spider.scraper_state.setdefault("validators", {})
+
+    def process_request(self, request):
+        if not request.meta.get("conditional_get"):
+            return None
+
+        cached = self.cache.get(self.crawler.spider.page_key(request.url))
+
+        if cached:
+            if cached.get("etag"):
+                request.headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                request.headers["If-Modified-Since"] = cached["last_modified"]
+            self.stats.inc_value("conditional_get/sent")
+
+        return None
+
+    def process_response(self, request, response):
+        if not request.meta.get("conditional_get"):
+            return response
+
+        if response.status == 304:
+            self.stats.inc_value("conditional_get/not_modified")
+            raise IgnoreRequest(f"Not modified since the last run: {request.url}")
+
+        validators = {}
+        if response.headers.get("ETag"):
+            validators["etag"] = response.headers.get("ETag").decode("utf-8")
+        if response.headers.get("Last-Modified"):
+            validators["last_modified"] = response.headers.get("Last-Modified").decode(
+                "utf-8"
+            )
+
+        if validators:
+            self.validators[request.url] = validators
+
+        return response
+
+    def page_completed(self, page_url):
+        """Keep the validators of a page whose new documents were all processed."""
+
+        if page_url in self.validators:
+            self.cache[self.crawler.spider.page_key(page_url)] = self.validators.pop(
+                page_url
+            )
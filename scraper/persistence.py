@@ -0,0 +1,322 @@
+"""Persistence of the event data between runs."""
+
+from collections.abc import MutableMapping
+import json
+import os
+import sqlite3
+import time
+
+# Key of the scraper state (caches reused by the next runs) in the event data
+STATE_KEY = "_scraper_state"
+
+# Scraper state file of local runs
+STATE_PATH = "scraper_state.json"
+
+
+def load_local_state():
+    """Returns the scraper state saved by a previous local run."""
+
+    try:
+        with open(STATE_PATH, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_local_state(state):
+    with open(STATE_PATH, "w") as file:
+        json.dump(state, file)
+
+
+class EventDataPersister:
+    """Write-behind storage of the event data.
+
+    Instead of storing the whole event data after each update, stores it once
+    `store_every` updates are pending, or when `store_interval` seconds have
+    passed since the last store. `flush()` stores any pending update.
+    """
+
+    def __init__(self, store, store_every, store_interval, stats):
+        self.store = store
+        self.store_every = store_every
+        self.store_interval = store_interval
+        self.stats = stats
+
+        self.pending = 0
+        self.last_store = time.monotonic()
+
+    def record(self):
+        """Mark the event data as updated, and store it if needed."""
+
+        self.pending += 1
+        self.stats.inc_value("event_data/updates")
+
+        if (
+            self.pending >= self.store_every
+            or time.monotonic() - self.last_store >= self.store_interval
+        ):
+            self.flush()
+
+    def touch(self):
+        """Mark the scraper state as updated, to be stored at the next flush."""
+
+        self.pending = max(self.pending, 1)
+
+    def flush(self):
+        """Store the event data if it has pending updates."""
+
+        if not self.store or not self.pending:
+            return
+
+        self.store()
+        self.pending = 0
+        self.last_store = time.monotonic()
+        self.stats.inc_value("event_data/stores")
+
+    @property
+    def stores_saved(self):
+        """Number of stores avoided compared to storing after each update
+        (and once more when the spider closes)."""
+
+        updates = self.stats.get_value("event_data/updates", 0)
+        stores = self.stats.get_value("event_data/stores", 0)
+
+        return max(updates + 1 - stores, 0)
+
+
+class EventDataJournal:
+    """Event data stored locally as a snapshot plus an append-only journal.
+
+    The snapshot is a JSON dict keyed by source_file_url, like the event data
+    itself. Each update is appended to the journal as one JSON line, and the
+    journal is merged into the snapshot once it holds more than `compact_after`
+    records, so that saving an update does not rewrite the whole history.
+    """
+
+    def __init__(self, path, compact_after, logger):
+        self.path = path
+        self.journal_path = path + ".log"
+        self.compact_after = compact_after
+        self.logger = logger
+
+        self.journal = None
+        self.journal_records = 0
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r") as file:
+                self.journal_records = sum(1 for _ in file)
+
+    def load(self):
+        """Returns the event data from the snapshot and the journal, or None."""
+
+        if not os.path.exists(self.path) and not os.path.exists(self.journal_path):
+            return None
+
+        if self.journal_records > self.compact_after:
+            self.compact()
+
+        return self.replay()
+
+    def replay(self):
+        """Read the snapshot and apply the records of the journal."""
+
+        data = {}
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                data = json.load(file)
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "r") as file:
+                for line in file:
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        # Record truncated by an interrupted run
+                        self.logger.warning(
+                            f"Skipping invalid record in {self.journal_path}"
+                        )
+                        continue
+                    data[key] = value
+
+        return data
+
+    def append(self, key, value):
+        """Add a record to the journal."""
+
+        if self.journal is None:
+            self.journal = open(self.journal_path, "a")
+
+        self.journal.write(json.dumps([key, value]) + "\n")
+        self.journal.flush()
+        self.journal_records += 1
+
+        if self.journal_records > self.compact_after:
+            self.compact()
+
+    def compact(self):
+        """Merge the journal into a new snapshot."""
+
+        self.close()
+        data = self.replay()
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file)
+        os.replace(tmp_path, self.path)
+
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.journal_records = 0
+
+        self.logger.info(f"Compacted {self.path} ({len(data)} documents)")
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+class SQLiteEventData(MutableMapping):
+    """Event data stored in a SQLite database instead of an in-memory dict.
+
+    Behaves like the event data dict (source_file_url -> record), so the spider
+    and pipelines can use either. Records are also indexed by target_year,
+    source_page_url and last_modified, and writes are buffered and committed
+    in batches of `batch_size`.
+    """
+
+    def __init__(self, path, batch_size):
+        self.path = path
+        self.batch_size = batch_size
+        self.pending = {}
+
+        self.connection = sqlite3.connect(path)
+        with self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS event_data (
+                    source_file_url TEXT PRIMARY KEY,
+                    target_year TEXT,
+                    source_page_url TEXT,
+                    last_modified TEXT,
+                    record TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS event_data_target_year
+                    ON event_data (target_year);
+                CREATE INDEX IF NOT EXISTS event_data_source_page_url
+                    ON event_data (source_page_url);
+                CREATE INDEX IF NOT EXISTS event_data_last_modified
+                    ON event_data (last_modified);
+                """)
+
+    def __getitem__(self, url):
+        if url in self.pending:
+            return self.pending[url]
+
+        row = self.connection.execute(
+            "SELECT record FROM event_data WHERE source_file_url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(url)
+
+        return json.loads(row[0])
+
+    def __contains__(self, url):
+        if url in self.pending:
+            return True
+
+        row = self.connection.execute(
+            "SELECT 1 FROM event_data WHERE source_file_url = ?", (url,)
+        ).fetchone()
+
+        return row is not None
+
+    def __setitem__(self, url, record):
+        self.pending[url] = record
+
+        if len(self.pending) >= self.batch_size:
+            self.commit()
+
+    def __delitem__(self, url):
+        self.commit()
+        with self.connection:
+            cursor = self.connection.execute(
+                "DELETE FROM event_data WHERE source_file_url = ?", (url,)
+            )
+        if not cursor.rowcount:
+            raise KeyError(url)
+
+    def __iter__(self):
+        self.commit()
+        for (url,) in self.connection.execute("SELECT source_file_url FROM event_data"):
+            yield url
+
+    def __len__(self):
+        self.commit()
+        return self.connection.execute("SELECT COUNT(*) FROM event_data").fetchone()[0]
+
+    def commit(self):
+        """Write the buffered records in one transaction."""
+
+        if not self.pending:
+            return
+
+        self.write(self.pending.items())
+        self.pending = {}
+
+    def write(self, records):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO event_data VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        url,
+                        record.get("target_year"),
+                        record.get("source_page_url"),
+                        record.get("last_modified"),
+                        json.dumps(record),
+                    )
+                    for url, record in records
+                ),
+            )
+
+    def import_json(self, data):
+        """Add the records of event data in its JSON format (a dict)."""
+
+        self.commit()
+        self.write(data.items())
+
+    def to_json(self):
+        """Returns the event data in its JSON format, as stored on DocumentCloud."""
+
+        self.commit()
+        return {
+            url: json.loads(record)
+            for url, record in self.connection.execute(
+                "SELECT source_file_url, record FROM event_data"
+            )
+        }
+
+    def for_year(self, year):
+        """Returns the records (url, record) seen for a target year."""
+
+        self.commit()
+        for url, record in self.connection.execute(
+            "SELECT source_file_url, record FROM event_data WHERE target_year = ?",
+            (str(year),),
+        ):
+            yield url, json.loads(record)
+
+    def for_page(self, source_page_url):
+        """Returns the records (url, record) seen on a documents page."""
+
+        self.commit()
+        for url, record in self.connection.execute(
+            "SELECT source_file_url, record FROM event_data WHERE source_page_url = ?",
+            (source_page_url,),
+        ):
+            yield url, json.loads(record)
+
+    def close(self):
+        self.commit()
+        self.connection.close()
@@ -4,26 +4,85 @@ import datetime
 import re
 import os
 import sys
+from collections import defaultdict
 from urllib.parse import urlparse
 import logging
 import json
 import hashlib
+import csv
+import gzip
+import time
+import functools
+import multiprocessing
+import threading
 
 from itemadapter import ItemAdapter
 
 from scrapy.exceptions import DropItem
+from scrapy.utils.defer import maybe_deferred_to_future
 
-from documentcloud.constants import SUPPORTED_EXTENSIONS
+from twisted.internet import task, threads
+from twisted.internet.defer import Deferred, DeferredList, fail
+from twisted.python.threadpool import ThreadPool
+
+from documentcloud.constants import BULK_LIMIT, SUPPORTED_EXTENSIONS
 
 from .corrections import corrections
 from .log import SilentDropItem
-from .departments import department_from_authority, departments_from_project_name
+from .departments import departments_tags
+from .instrumentation import format_pipeline_stats
+from .signals import document_uploaded
+from .sharding import UploadRateLimiter
+from .persistence import (
+    STATE_KEY,
+    EventDataJournal,
+    EventDataPersister,
+    SQLiteEventData,
+    load_local_state,
+    save_local_state,
+)
+
+# Searches for the documents created by a failed bulk request, until the
+# results settle, and seconds between them
+BULK_LOOKUP_ATTEMPTS = 4
+BULK_LOOKUP_DELAY = 5
+
+
+def quiet_client_loggers():
+    """Log only the warnings of the DocumentCloud client, which logs its
+    requests at INFO (including the whole event data when it is stored)."""
+
+    for name in ("documentcloud", "squarelet"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def serialize_token_refresh(client):
+    """Let one thread at a time refresh the tokens of a DocumentCloud client
+    shared by the upload worker threads.
+
+    A request refused with 403 or 429 refreshes the tokens before it is retried:
+    concurrent refreshes would race on the refresh token and on the session
+    headers. A thread whose request was refused while another one refreshed the
+    tokens retries with the new ones.
+    """
+
+    lock = threading.Lock()
+    set_tokens = client._set_tokens
+
+    def set_tokens_once():
+        access_token = client.access_token
+        with lock:
+            if client.access_token == access_token:
+                set_tokens()
+
+    client._set_tokens = set_tokens_once
 
 
 class SpiderPipeline:
     """Base class for pipelines that need access to the spider instance.
 
-    Provides from_crawler() to store spider as self.spider.
+    Provides from_crawler() to store spider as self.spider, and to time
+    process_item() with PIPELINE_STATS_ENABLED.
     Inherit from this class instead of defining from_crawler() in each pipeline.
     """
 
@@ -31,10 +90,14 @@ class SpiderPipeline:
     def from_crawler(cls, crawler):
         pipeline = cls()
         pipeline.spider = crawler.spider
+        if crawler.spider.pipeline_stats:
+            pipeline.process_item = crawler.spider.pipeline_stats.timed(
+                cls.__name__, pipeline.process_item
+            )
         return pipeline
 
 
-class ParseDatePipeline:
+class ParseDatePipeline(SpiderPipeline):
     """Parse dates from scraped data."""
 
     def process_item(self, item):
@@ -60,7 +123,7 @@ class ParseDatePipeline:
         return item
 
 
-class CategoryPipeline:
+class CategoryPipeline(SpiderPipeline):
     """Attributes the final category of the document."""
 
     def process_item(self, item):
@@ -82,7 +145,7 @@ class CategoryPipeline:
         return item
 
 
-class SourceFilenamePipeline:
+class SourceFilenamePipeline(SpiderPipeline):
     """Adds the source_filename field based on source_file_url."""
 
     def process_item(self, item):
@@ -94,7 +157,7 @@ class SourceFilenamePipeline:
         return item
 
 
-class UnsupportedFiletypePipeline:
+class UnsupportedFiletypePipeline(SpiderPipeline):
 
     def process_item(self, item):
 
@@ -108,7 +171,7 @@ class UnsupportedFiletypePipeline:
             return item
 
 
-class BeautifyPipeline:
+class BeautifyPipeline(SpiderPipeline):
     def process_item(self, item):
         """Beautify & harmonize project & title names."""
 
@@ -124,13 +187,24 @@ class BeautifyPipeline:
 
 
 class UploadLimitPipeline(SpiderPipeline):
-    """Sends the signal to close the spider once the upload limit is attained."""
+    """Sends the signal to close the spider once the upload limit is attained.
+
+    Once the time budget is exhausted, documents are not uploaded anymore: they
+    are saved in the checkpoint for the next run.
+    """
 
     def open_spider(self):
         self.number_of_docs = 0
 
     def process_item(self, item):
-        self.number_of_docs += 1
+        if self.spider.time_limit_attained:
+            raise SilentDropItem("Time limit attained.")
+
+        if self.spider.upload_counter:
+            # Sharded run: the limit applies to all the shards
+            self.number_of_docs = self.spider.upload_counter.increment()
+        else:
+            self.number_of_docs += 1
 
         if (
             self.spider.upload_limit == 0
@@ -142,7 +216,7 @@ class UploadLimitPipeline(SpiderPipeline):
             raise SilentDropItem("Upload limit exceeded.")
 
 
-class CorrectionsPipeline:
+class CorrectionsPipeline(SpiderPipeline):
     """Manually correct problematic documents listed in corrections.py"""
 
     def process_item(self, item):
@@ -158,30 +232,42 @@ class CorrectionsPipeline:
         return item
 
 
-class TagDepartmentsPipeline:
-
-    def process_item(self, item):
+class TagDepartmentsPipeline(SpiderPipeline):
+    """Tags the departments found in the project name.
 
-        authority_department = department_from_authority(item["authority"])
+    The documents of a project (decision, formulaire, recours, letters...)
+    share its name, so the departments are kept in a LRU cache of
+    ENRICHMENT_CACHE_SIZE entries.
+    """
 
-        if authority_department:
-            item["departments_sources"] = ["authority"]
-            item["departments"] = [authority_department]
+    def open_spider(self):
+        size = self.spider.settings.getint("ENRICHMENT_CACHE_SIZE")
+        self.departments_tags = functools.lru_cache(maxsize=size)(departments_tags)
 
-        else:
+    def close_spider(self):
+        info = self.departments_tags.cache_info()
+        stats = self.spider.crawler.stats
+        stats.set_value("enrichment/departments/hits", info.hits)
+        stats.set_value("enrichment/departments/misses", info.misses)
 
-            project_departments = departments_from_project_name(item["project"])
+    def process_item(self, item):
 
-            if project_departments:
+        sources, departments = self.departments_tags(item["authority"], item["project"])
 
-                item["departments_sources"] = ["regex"]
-                item["departments"] = project_departments
+        if departments:
+            # Lists of their own, as the cached tuples are shared between items
+            item["departments_sources"] = list(sources)
+            item["departments"] = list(departments)
 
         return item
 
 
 class HandleErrorsPipeline(SpiderPipeline):
-    """Mark docs with errors."""
+    """Mark docs with errors.
+
+    With COMPACT_ITEMS, full_info is only kept for the docs with errors (it is
+    only reported in the mail for them).
+    """
 
     def process_item(self, item):
 
@@ -199,10 +285,12 @@ class HandleErrorsPipeline(SpiderPipeline):
             print(item)
         else:
             item["error"] = False
+            if self.spider.settings.getbool("COMPACT_ITEMS"):
+                item.pop("full_info", None)
         return item
 
 
-class ProjectIDPipeline:
+class ProjectIDPipeline(SpiderPipeline):
 
     def process_item(self, item):
 
@@ -222,11 +310,28 @@ class UploadPipeline(SpiderPipeline):
     """Upload document to DocumentCloud & store event data."""
 
     def open_spider(self):
-        documentcloud_logger = logging.getLogger("documentcloud")
-        documentcloud_logger.setLevel(logging.WARNING)
+        quiet_client_loggers()
 
-        squarelet_logger = logging.getLogger("squarelet")
-        squarelet_logger.setLevel(logging.WARNING)
+        # SQLite database replacing the in-memory event data dict
+        if self.spider.settings.get("EVENT_DATA_BACKEND") == "sqlite":
+            self.sqlite_path = self.spider.settings.get("EVENT_DATA_SQLITE_PATH")
+            sqlite_exists = os.path.exists(self.sqlite_path)
+        else:
+            self.sqlite_path = None
+
+        # Local event data, as a snapshot + journal (dry runs and local runs)
+        if self.spider.settings.getbool("EVENT_DATA_JOURNAL") and (
+            self.spider.dry_run or not self.spider.run_id
+        ):
+            self.journal = EventDataJournal(
+                "event_data.json",
+                compact_after=self.spider.settings.getint(
+                    "EVENT_DATA_JOURNAL_COMPACT_AFTER"
+                ),
+                logger=self.spider.logger,
+            )
+        else:
+            self.journal = None
 
         if not self.spider.dry_run:
             try:
@@ -237,6 +342,12 @@ class UploadPipeline(SpiderPipeline):
                     e.__traceback__
                 )
                 sys.exit(1)
+        elif self.sqlite_path and sqlite_exists:
+            # Local runs: the database already holds the event data
+            self.spider.event_data = None
+        elif self.journal:
+            self.spider.logger.info("Loading event data from local journal...")
+            self.spider.event_data = self.journal.load()
         else:
             # Load from json if present
             try:
@@ -250,15 +361,362 @@ class UploadPipeline(SpiderPipeline):
             except:
                 self.spider.event_data = None
 
+        # Scraper state (caches reused by the next runs), stored with the event
+        # data on DocumentCloud, or in a separate file for local runs
+        if not self.spider.dry_run:
+            self.spider.scraper_state = (self.spider.event_data or {}).pop(
+                STATE_KEY, {}
+            )
+        else:
+            self.spider.scraper_state = load_local_state()
+
+        if self.sqlite_path:
+            event_data = SQLiteEventData(
+                self.sqlite_path,
+                batch_size=self.spider.settings.getint("EVENT_DATA_SQLITE_BATCH_SIZE"),
+            )
+            if self.spider.event_data:
+                event_data.import_json(self.spider.event_data)
+            self.spider.event_data = event_data
+
         if self.spider.event_data:
             self.spider.logger.info(
                 f"Loaded event data ({len(self.spider.event_data)} documents)"
             )
         else:
             self.spider.logger.info("No event data was loaded.")
-            self.spider.event_data = {}
+            if not self.sqlite_path:
+                self.spider.event_data = {}
 
-    def process_item(self, item):
+        # Event data is stored on DocumentCloud only from the web interface
+        if not self.spider.dry_run and self.spider.run_id:
+            store = lambda: self.spider.store_event_data(self.event_data_json())
+        else:
+            store = None
+
+        self.spider.event_data_persister = EventDataPersister(
+            store,
+            store_every=self.spider.settings.getint("EVENT_DATA_STORE_EVERY"),
+            store_interval=self.spider.settings.getfloat("EVENT_DATA_STORE_INTERVAL"),
+            stats=self.spider.crawler.stats,
+        )
+
+        self.store_loop = task.LoopingCall(self.spider.event_data_persister.flush)
+        self.store_loop.start(
+            self.spider.settings.getfloat("EVENT_DATA_STORE_INTERVAL"), now=False
+        )
+
+        # Upload rate limit, shared by the shards of a sharded run
+        self.rate_limiter = self.spider.upload_rate_limiter
+        upload_rate_limit = self.spider.settings.getfloat("UPLOAD_RATE_LIMIT")
+        if self.rate_limiter is None and upload_rate_limit:
+            self.rate_limiter = UploadRateLimiter(upload_rate_limit, multiprocessing)
+
+        # Worker pool for uploads (0 = upload synchronously)
+        upload_concurrency = self.spider.settings.getint("UPLOAD_CONCURRENCY")
+        if upload_concurrency > 0:
+            self.upload_pool = ThreadPool(
+                minthreads=0, maxthreads=upload_concurrency, name="UploadPipeline"
+            )
+            self.upload_pool.start()
+            serialize_token_refresh(self.spider.client)
+        else:
+            self.upload_pool = None
+        # Deferreds of the uploads running (or waiting) in the worker pool
+        self.pool_uploads = set()
+
+        # Documents whose upload request failed, possibly after creating them:
+        # looked up before they are uploaded again (kept for the next runs)
+        self.uploads_in_doubt = set(
+            self.spider.scraper_state.get("uploads_in_doubt", {})
+        )
+
+        # Bulk upload batches (0 = upload documents one by one)
+        self.batch_size = min(
+            self.spider.settings.getint("UPLOAD_BATCH_SIZE"), BULK_LIMIT
+        )
+        self.batch_max_age = self.spider.settings.getfloat("UPLOAD_BATCH_MAX_AGE")
+        self.batch = []
+        self.batch_timer = None
+
+    def event_data_json(self):
+        """The event data in the JSON format stored on DocumentCloud."""
+
+        if self.sqlite_path:
+            event_data = self.spider.event_data.to_json()
+        else:
+            event_data = self.spider.event_data
+
+        return {**event_data, STATE_KEY: self.spider.scraper_state}
+
+    def upload_parameters(self, item, data):
+        """DocumentCloud upload parameters for a document."""
+
+        return dict(
+            title=item["title"],
+            description=item["project"],
+            publish_at=item["publication_datetime_dcformat"],
+            source="www.igedd.developpement-durable.gouv.fr",
+            language="fra",
+            access=self.spider.access_level,
+            data=data,
+        )
+
+    def upload_document(self, item, data, reserved=False):
+        """Upload a document to DocumentCloud (blocking), unless an upload whose
+        response was lost created it already. Waits for the rate limit, unless
+        the upload was `reserved` already (see rate_limit_delay)."""
+
+        if self.created_in_doubt([(item, data)]):
+            return
+
+        if self.rate_limiter and not reserved:
+            self.rate_limiter.wait()
+
+        self.uploads_in_doubt.add(item["source_file_url"])
+        self.spider.client.documents.upload(
+            item["source_file_url"],
+            project=self.spider.target_project,
+            **self.upload_parameters(item, data),
+        )
+        self.uploads_in_doubt.discard(item["source_file_url"])
+
+    def created_in_doubt(self, documents):
+        """Source file URLs of the documents whose upload failed in doubt (during
+        this run or a previous one) and which were created anyway (blocking)."""
+
+        in_doubt = [
+            (item, data)
+            for item, data in documents
+            if item["source_file_url"] in self.uploads_in_doubt
+        ]
+        if not in_doubt:
+            return set()
+
+        created = self.existing_documents(in_doubt)
+        self.uploads_in_doubt.difference_update(created)
+        return created
+
+    def upload_queued_document(self, item, data):
+        """Upload a document from the worker pool (blocking), unless the time
+        budget was exhausted while it was waiting. Returns True if uploaded."""
+
+        if self.spider.time_limit_attained:
+            return False
+
+        self.upload_document(item, data)
+        return True
+
+    def in_upload_pool(self, function, *args):
+        """Run a blocking upload function in the worker pool. Returns a Deferred,
+        kept until it fires so that close_spider can wait for it."""
+        from twisted.internet import reactor
+
+        dfd = threads.deferToThreadPool(reactor, self.upload_pool, function, *args)
+        self.pool_uploads.add(dfd)
+
+        def finished(result):
+            self.pool_uploads.discard(dfd)
+            return result
+
+        return dfd.addBoth(finished)
+
+    def rate_limit_delay(self, documents=1):
+        """Reserve the uploads of `documents` documents with the rate limit.
+        Returns a Deferred fired once they may start, so that the synchronous
+        uploads do not block the reactor while they wait."""
+        from twisted.internet import reactor
+
+        delay = self.rate_limiter.reserve(documents) if self.rate_limiter else 0
+        return task.deferLater(reactor, max(delay, 0), lambda: None)
+
+    def existing_documents(self, documents):
+        """Source file URLs of the documents of a batch that are already in the
+        target project (blocking)."""
+
+        query = " OR ".join(
+            f'data_source_file_url:"{item["source_file_url"]}"' for item, _ in documents
+        )
+        # All the pages of results: a document may have been created twice
+        results = self.spider.client.documents.search(
+            f"+project:{self.spider.target_project} +({query})",
+            per_page=BULK_LIMIT,
+        )
+
+        existing = set()
+        for document in results:
+            urls = document.data.get("source_file_url", [])
+            existing.update([urls] if isinstance(urls, str) else urls)
+        return existing
+
+    def created_documents(self, documents):
+        """Source file URLs of the documents of a failed bulk request that were
+        created anyway (blocking).
+
+        Documents are only found by the search once they are indexed, so the
+        search is repeated until all the documents are found, or the same ones
+        twice in a row. Finding none is not conclusive (they may all be waiting
+        to be indexed). Returns None if the results do not settle.
+        """
+
+        urls = {item["source_file_url"] for item, _ in documents}
+        found = None
+
+        for _ in range(BULK_LOOKUP_ATTEMPTS):
+            time.sleep(BULK_LOOKUP_DELAY)
+            previous, found = found, self.existing_documents(documents) & urls
+            if found == urls or (found and found == previous):
+                return found
+
+        return None
+
+    def upload_documents(self, documents, reserved=False):
+        """Create a batch of documents from their URLs in one API call (blocking),
+        unless the time budget was exhausted while the batch was waiting. Waits
+        for the rate limit, unless the uploads were `reserved` already.
+
+        Returns the upload error (or None) of each document. The documents are
+        in doubt from the request until it succeeds (see uploads_in_doubt).
+
+        If the bulk request fails, it may still have created some documents:
+        they are looked up until the search results settle, and the others are
+        uploaded one by one, so that a single bad document does not fail the
+        whole batch. If they cannot be looked up, the whole batch fails and is
+        left for the next run, which looks the documents up before uploading
+        them again.
+        """
+
+        if self.spider.time_limit_attained:
+            # Saved in the checkpoint for the next run
+            return [SilentDropItem("Time limit attained.")] * len(documents)
+
+        try:
+            created = self.created_in_doubt(documents)
+        except Exception as e:
+            return [e] * len(documents)
+        errors = dict.fromkeys(created)
+        documents_left = [
+            (item, data)
+            for item, data in documents
+            if item["source_file_url"] not in created
+        ]
+        urls = [item["source_file_url"] for item, _ in documents_left]
+
+        if documents_left:
+            if self.rate_limiter and not reserved:
+                self.rate_limiter.wait(len(documents_left))
+
+            self.uploads_in_doubt.update(urls)
+            try:
+                self.spider.client.post(
+                    "documents/",
+                    json=[
+                        {
+                            **self.upload_parameters(item, data),
+                            "projects": [self.spider.target_project],
+                            "file_url": item["source_file_url"],
+                        }
+                        for item, data in documents_left
+                    ],
+                )
+            except Exception as e:
+                errors.update(self.recover_batch(documents_left, e, reserved))
+            else:
+                self.uploads_in_doubt.difference_update(urls)
+                errors.update(dict.fromkeys(urls))
+
+        return [errors[item["source_file_url"]] for item, _ in documents]
+
+    def recover_batch(self, documents, bulk_error, reserved=False):
+        """Uploads the documents of a failed bulk request that were not created
+        (blocking). Returns the upload error (or None) of each URL."""
+
+        try:
+            created = self.created_documents(documents)
+        except Exception as e:
+            created = None
+            reason = f"could not be looked up ({e})"
+        else:
+            reason = "were still being indexed"
+
+        if created is None:
+            self.spider.logger.warning(
+                f"Bulk upload of {len(documents)} documents failed ({bulk_error}), and the documents created {reason}: they are left for the next run"
+            )
+            return {item["source_file_url"]: bulk_error for item, _ in documents}
+
+        self.spider.logger.warning(
+            f"Bulk upload of {len(documents)} documents failed ({bulk_error}), {len(created)} were created, uploading the others one by one"
+        )
+
+        errors = {}
+        for item, data in documents:
+            url = item["source_file_url"]
+            # Either created or not by the bulk request, no longer in doubt
+            self.uploads_in_doubt.discard(url)
+            if url in created:
+                errors[url] = None
+                continue
+            try:
+                self.upload_document(item, data, reserved)
+            except Exception as e:
+                errors[url] = e
+            else:
+                errors[url] = None
+        return errors
+
+    def add_to_batch(self, item, data):
+        """Queue a document for the next bulk upload.
+
+        Returns a Deferred fired once the document is uploaded, or failed.
+        """
+        from twisted.internet import reactor
+
+        if self.spider.time_limit_attained:
+            # Saved in the checkpoint for the next run
+            return fail(SilentDropItem("Time limit attained."))
+
+        uploaded = Deferred()
+        self.batch.append((item, data, uploaded))
+
+        if len(self.batch) >= self.batch_size:
+            self.flush_batch()
+        elif self.batch_timer is None:
+            self.batch_timer = reactor.callLater(self.batch_max_age, self.flush_batch)
+
+        return uploaded
+
+    def flush_batch(self):
+        """Upload the documents of the current batch."""
+
+        if self.batch_timer is not None and self.batch_timer.active():
+            self.batch_timer.cancel()
+        self.batch_timer = None
+
+        batch, self.batch = self.batch, []
+        documents = [(item, data) for item, data, _ in batch]
+
+        if self.upload_pool:
+            dfd = self.in_upload_pool(self.upload_documents, documents)
+        else:
+            dfd = self.rate_limit_delay(len(documents))
+            dfd.addCallback(lambda _: self.upload_documents(documents, reserved=True))
+
+        def fire(errors):
+            for (_, _, uploaded), error in zip(batch, errors):
+                if error is None:
+                    uploaded.callback(None)
+                else:
+                    uploaded.errback(error)
+
+        def fire_all(failure):
+            for _, _, uploaded in batch:
+                uploaded.errback(failure)
+
+        dfd.addCallbacks(fire, fire_all)
+        return dfd
+
+    async def process_item(self, item):
 
         data = {
             "authority": item["authority"],
@@ -284,23 +742,48 @@ class UploadPipeline(SpiderPipeline):
         if item["error"]:
             data["_tag"] = "hidden"
 
+        upload_start = time.monotonic()
+
         try:
             if not self.spider.dry_run:
-                self.spider.client.documents.upload(
-                    item["source_file_url"],
-                    project=self.spider.target_project,
-                    title=item["title"],
-                    description=item["project"],
-                    publish_at=item["publication_datetime_dcformat"],
-                    source="www.igedd.developpement-durable.gouv.fr",
-                    language="fra",
-                    access=self.spider.access_level,
-                    data=data,
-                )
+                if self.batch_size:
+                    await maybe_deferred_to_future(self.add_to_batch(item, data))
+                elif self.upload_pool:
+                    # Run the upload in the worker pool without blocking the reactor
+                    uploaded = await maybe_deferred_to_future(
+                        self.in_upload_pool(self.upload_queued_document, item, data)
+                    )
+                    if not uploaded:
+                        # Saved in the checkpoint for the next run
+                        raise SilentDropItem("Time limit attained.")
+                else:
+                    await maybe_deferred_to_future(self.rate_limit_delay())
+                    self.upload_document(item, data, reserved=True)
+        except DropItem:
+            raise
         except Exception as e:
             raise Exception("Upload error").with_traceback(e.__traceback__)
 
         else:  # No upload error, add to event_data
+            if not self.spider.dry_run:
+                stats = self.spider.crawler.stats
+                if stats.get_value("upload/time_to_first_upload") is None:
+                    elapsed = datetime.datetime.now(
+                        datetime.timezone.utc
+                    ) - stats.get_value("start_time")
+                    stats.set_value(
+                        "upload/time_to_first_upload",
+                        round(elapsed.total_seconds(), 1),
+                    )
+
+                self.spider.crawler.signals.send_catch_log(
+                    document_uploaded,
+                    item=item,
+                    latency=time.monotonic() - upload_start,
+                )
+
+            # Back on the reactor thread: uploads may finish in any order, but
+            # each one only records its own source_file_url.
             last_modified = datetime.datetime.strptime(
                 item["publication_lastmodified"], "%a, %d %b %Y %H:%M:%S %Z"
             ).isoformat()
@@ -310,64 +793,186 @@ class UploadPipeline(SpiderPipeline):
                 "last_modified": last_modified,
                 "last_seen": now,
                 "target_year": item["year"],
+                "source_page_url": item["source_page_url"],
             }
 
-            # Save event data after each upload
-            if self.spider.run_id:  # only from the web interface
-                self.spider.store_event_data(self.spider.event_data)
+            self.spider.event_data_persister.record()
+
+            if self.journal and not self.sqlite_path and not self.spider.run_id:
+                self.journal.append(
+                    item["source_file_url"],
+                    self.spider.event_data[item["source_file_url"]],
+                )
+
+            self.spider.document_done(item)
 
         return item
 
-    def close_spider(self):
+    def save_uploads_in_doubt(self):
+        """Saves the uploads in doubt of the documents left for the next run in
+        the scraper state. Returns True if it needs to be stored."""
+
+        saved = self.spider.scraper_state.get("uploads_in_doubt", {})
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        uploads_in_doubt = {
+            url: saved.get(url, now)
+            for url in self.uploads_in_doubt
+            if url in self.spider.followed_documents
+        }
+
+        if uploads_in_doubt == saved:
+            return False
+        if uploads_in_doubt:
+            self.spider.scraper_state["uploads_in_doubt"] = uploads_in_doubt
+        else:
+            self.spider.scraper_state.pop("uploads_in_doubt", None)
+        return True
+
+    async def close_spider(self):
         """Update event data when the spider closes."""
 
+        if self.batch:
+            await maybe_deferred_to_future(self.flush_batch())
+
+        if self.upload_pool:
+            # Wait for the uploads in flight without blocking the reactor (their
+            # callbacks update event data), then stop the pool from another
+            # thread, as stopping it joins its threads
+            await maybe_deferred_to_future(
+                DeferredList(list(self.pool_uploads), consumeErrors=True)
+            )
+            await maybe_deferred_to_future(threads.deferToThread(self.upload_pool.stop))
+
+        if self.store_loop.running:
+            self.store_loop.stop()
+
+        # Documents left (time or upload limit, errors) are resumed by the next
+        # run, and the documents pages found are requested directly by the next runs.
+        # Expired headers are dropped from the head cache.
+        state_updates = [
+            self.spider.save_checkpoint(),
+            self.spider.save_nav_map(),
+            self.spider.prune_head_cache(),
+            self.save_uploads_in_doubt(),
+        ]
+        if any(state_updates):
+            self.spider.event_data_persister.touch()
+
         if not self.spider.dry_run and self.spider.run_id:
-            self.spider.store_event_data(self.spider.event_data)
+            self.spider.event_data_persister.flush()
             self.spider.logger.info(
-                f"Uploaded event data ({len(self.spider.event_data)} documents)"
+                f"Event data up to date ({len(self.spider.event_data)} documents)"
+            )
+
+            stores_saved = self.spider.event_data_persister.stores_saved
+            self.spider.crawler.stats.set_value("event_data/stores_saved", stores_saved)
+            self.spider.logger.info(
+                f"Stored event data {self.spider.crawler.stats.get_value('event_data/stores')} times ({stores_saved} stores saved)"
             )
 
             if self.spider.upload_event_data:
-                # Upload the event_data to the DocumentCloud interface
+                # Upload the event_data to the DocumentCloud interface, with the
+                # other run files
                 now = datetime.datetime.now()
                 timestamp = now.strftime("%Y%m%d_%H%M")
                 filename = f"event_data_IGEDD_{timestamp}.json"
 
-                with open(filename, "w+") as event_data_file:
-                    json.dump(self.spider.event_data, event_data_file)
-                    self.spider.upload_file(event_data_file)
+                with open(filename, "w") as event_data_file:
+                    json.dump(self.event_data_json(), event_data_file)
+                self.spider.attach_run_file(filename)
+
+        if self.sqlite_path:
+            # After the last store of event data, which reads the database
+            self.spider.event_data.close()
+            if not self.spider.run_id:
+                self.spider.logger.info(f"Saved event data to {self.sqlite_path}")
+
+        elif self.journal:
+            self.journal.close()
+            if not self.spider.run_id:
                 self.spider.logger.info(
-                    f"Uploaded event data to the Documentcloud interface."
+                    f"Saved event data journal ({len(self.spider.event_data)} documents)"
                 )
 
-        if not self.spider.run_id:
+        elif not self.spider.run_id:
             with open("event_data.json", "w") as file:
                 json.dump(self.spider.event_data, file)
                 self.spider.logger.info(
                     f"Saved file event_data.json ({len(self.spider.event_data)} documents)"
                 )
 
+        if not self.spider.run_id:
+            save_local_state(self.spider.scraper_state)
+
 
 class MailPipeline(SpiderPipeline):
-    """Send scraping run report."""
+    """Send scraping run report.
+
+    Items are not kept until the end of the run: each one is written to a
+    compressed CSV list as it arrives, and only the first MAIL_REPORT_MAX_ITEMS
+    items with and without errors are kept (formatted) for the mail, along with
+    counts by category and year. The complete list is uploaded to the add-on run
+    (in the archive of the run files), as mails cannot have attachments.
+
+    With MAIL_REPORT_PATH (shards of a sharded run), the report is written to
+    this JSON file instead of being sent, and the reports of the shards are
+    merged and sent by the parent process.
+    """
+
+    list_fields = [
+        "error",
+        "title",
+        "project",
+        "authority",
+        "category",
+        "category_local",
+        "publication_date",
+        "source_file_url",
+        "source_page_url",
+        "year",
+    ]
 
     def open_spider(self):
+        self.max_items = self.spider.settings.getint("MAIL_REPORT_MAX_ITEMS")
+
+        self.count_ok = 0
+        self.count_with_error = 0
         self.items_ok = []
         self.items_with_error = []
 
+        # (category, year) -> [new documents, errors]
+        self.counts = defaultdict(lambda: [0, 0])
+
+        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M")
+        self.list_path = f"report_IGEDD_{timestamp}.csv.gz"
+        self.list_file = gzip.open(self.list_path, "wt", newline="")
+        self.list_writer = csv.DictWriter(
+            self.list_file, fieldnames=self.list_fields, extrasaction="ignore"
+        )
+        self.list_writer.writeheader()
+
     def process_item(self, item):
 
+        self.list_writer.writerow(ItemAdapter(item).asdict())
+
+        counts = self.counts[(item["category"], str(item["year"]))]
+
         if item["error"] == True:
-            self.items_with_error.append(item)
+            self.count_with_error += 1
+            counts[1] += 1
+            if len(self.items_with_error) < self.max_items:
+                self.items_with_error.append(self.print_item(item, error=True))
         else:
-            self.items_ok.append(item)
+            self.count_ok += 1
+            counts[0] += 1
+            if len(self.items_ok) < self.max_items:
+                self.items_ok.append(self.print_item(item))
 
         return item
 
-    def close_spider(self):
-
-        def print_item(item, error=False):
-            item_string = f"""
+    @staticmethod
+    def print_item(item, error=False):
+        item_string = f"""
             title: {item["title"]}
             project: {item["project"]}
             authority: {item["authority"]}
@@ -379,32 +984,113 @@ class MailPipeline(SpiderPipeline):
             year: {item["year"]}
             """
 
-            if error:
-                item_string = item_string + f"\nfull_info: {item['full_info']}"
+        # Not kept in the checkpoint for resumed documents
+        if error and item.get("full_info"):
+            item_string = item_string + f"\nfull_info: {item['full_info']}"
 
-            return item_string
+        return item_string
 
-        if len(self.spider.target_years) == 1:
-            year_range_str = str(self.spider.target_years[0])
+    @staticmethod
+    def list_content(title, items, count, list_path):
+        content = f"{title} ({count})\n\n" + "\n\n".join(items)
+
+        if count > len(items):
+            content += (
+                f"\n\n... and {count - len(items)} more, "
+                f"see the complete list ({list_path} in the files of the run)"
+            )
+
+        return content
+
+    def report(self):
+        """The report of the run (JSON-serializable)."""
+
+        return {
+            "count_ok": self.count_ok,
+            "count_with_error": self.count_with_error,
+            "items_ok": self.items_ok,
+            "items_with_error": self.items_with_error,
+            "counts": [
+                [category, year, ok, errors]
+                for (category, year), (ok, errors) in self.counts.items()
+            ],
+            "list_path": self.list_path,
+        }
+
+    @classmethod
+    def mail(cls, report, target_years, run_name, run_id, dry_run, latency_table=""):
+        """Returns the subject and content of the mail of a report."""
+
+        if len(target_years) == 1:
+            year_range_str = str(target_years[0])
         else:
-            year_range_str = f"{str(self.spider.target_years[0])}-{str(self.spider.target_years[-1])}"
+            year_range_str = f"{str(target_years[0])}-{str(target_years[-1])}"
 
-        subject = f"IGEDD Scraper {year_range_str} (Errors: {len(self.items_with_error)} | New: {len(self.items_ok)}) [{self.spider.run_name}]"
+        subject = f"IGEDD Scraper {year_range_str} (Errors: {report['count_with_error']} | New: {report['count_ok']}) [{run_name}]"
 
-        if self.spider.dry_run:
+        if dry_run:
             subject = "[dry run] " + subject
 
-        errors_content = f"ERRORS ({len(self.items_with_error)})\n\n" + "\n\n".join(
-            [print_item(item, error=True) for item in self.items_with_error]
+        summary_content = "SUMMARY\n\n" + "\n".join(
+            f"{category} {year}: {ok} new, {errors} errors"
+            for category, year, ok, errors in sorted(report["counts"])
         )
 
-        ok_content = f"SCRAPED ITEMS ({len(self.items_ok)})\n\n" + "\n\n".join(
-            [print_item(item) for item in self.items_ok]
+        list_path = os.path.basename(report["list_path"])
+        errors_content = cls.list_content(
+            "ERRORS", report["items_with_error"], report["count_with_error"], list_path
+        )
+        ok_content = cls.list_content(
+            "SCRAPED ITEMS", report["items_ok"], report["count_ok"], list_path
         )
 
-        start_content = f"IGEDD Scraper Addon Run {self.spider.run_id}"
+        start_content = f"IGEDD Scraper Addon Run {run_id}"
 
-        content = "\n\n".join([start_content, errors_content, ok_content])
+        sections = [start_content, summary_content]
+
+        if latency_table:
+            sections.append(f"PIPELINE LATENCY\n\n{latency_table}")
+
+        content = "\n\n".join(sections + [errors_content, ok_content])
+
+        return subject, content
+
+    def close_spider(self):
+
+        self.list_file.close()
+
+        # Written before the report, which includes them
+        if self.spider.pipeline_stats:
+            self.spider.pipeline_stats.write(self.spider.crawler.stats)
+            self.spider.logger.info(
+                "Item pipeline latency:\n"
+                + format_pipeline_stats(self.spider.crawler.stats.get_stats())
+            )
+
+        report_path = self.spider.settings.get("MAIL_REPORT_PATH")
+        if report_path:
+            with open(report_path, "w") as file:
+                json.dump(self.report(), file)
+            return
+
+        subject, content = self.mail(
+            self.report(),
+            self.spider.target_years,
+            self.spider.run_name,
+            self.spider.run_id,
+            self.spider.dry_run,
+            format_pipeline_stats(self.spider.crawler.stats.get_stats()),
+        )
+
+        # Uploaded with the other run files of an add-on run, deleted otherwise
+        if (
+            not self.spider.dry_run
+            and self.spider.run_id
+            and self.count_ok + self.count_with_error
+        ):
+            self.spider.attach_run_file(self.list_path)
+        else:
+            os.remove(self.list_path)
 
         if not self.spider.dry_run:
             self.spider.send_mail(subject, content)
@@ -16,6 +16,10 @@ BOT_NAME = "IGEDD Scraper"
 SPIDER_MODULES = ["scraper.spiders"]
 NEWSPIDER_MODULE = "scraper.spiders"
 
+# Page the crawl starts from. Can point to a local replay of the site (see
+# benchmarks/replay.py).
+START_URL = "https://www.igedd.developpement-durable.gouv.fr/l-autorite-environnementale-r145.html"
+
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 USER_AGENT = "Disclose DocumentCloud Add-On - contact tech@disclose.ngo"
@@ -34,6 +38,23 @@ DOWNLOAD_DELAY = 1.5
 # CONCURRENT_REQUESTS_PER_DOMAIN = 16
 # CONCURRENT_REQUESTS_PER_IP = 16
 
+# By default, requests are prioritized so that documents are uploaded early in
+# the run (documents pages of the newest year first, then HEAD requests of
+# documents, then navigation pages). Set to True to crawl in breadth-first
+# order instead.
+BREADTH_FIRST = False
+
+# Delay and concurrency of each host (download slot), instead of DOWNLOAD_DELAY.
+# Document files are mostly on the webissimo hosts, which only get HEAD
+# requests: they have their own slots, so these requests do not wait behind
+# the listing pages of www.igedd. With AutoThrottle, the delay of each slot is
+# adjusted separately, never below the delay set here (see SlotAutoThrottle).
+DOWNLOAD_SLOTS = {
+    "www.igedd.developpement-durable.gouv.fr": {"concurrency": 2, "delay": 1.5},
+    "webissimo.developpement-durable.gouv.fr": {"concurrency": 4, "delay": 0.25},
+    "webissimo-inter.e2.rie.gouv.fr": {"concurrency": 4, "delay": 0.25},
+}
+
 # Disable cookies (enabled by default)
 # Set to false following advice from Scrapy's docs
 # https://docs.scrapy.org/en/latest/topics/practices.html#avoiding-getting-banned
@@ -56,15 +77,55 @@ COOKIES_ENABLED = False
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    "scraper.middlewares.ScraperDownloaderMiddleware": 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    # "scraper.middlewares.ScraperDownloaderMiddleware": 543,
+    "scraper.middlewares.ConditionalGetMiddleware": 560,
+}
+
+# Send If-None-Match / If-Modified-Since for documents pages, using the
+# validators of the previous runs, and skip the pages that were not modified
+CONDITIONAL_GET_ENABLED = True
+
+# Skip documents pages whose content (.texte-article) has the same hash as when
+# all their documents were last processed
+PAGE_FINGERPRINTS_ENABLED = True
+
+# Date "Avis rendus" and "Saisines" documents with the date written on the
+# listing page instead of sending a HEAD request for their Last-Modified header
+# (which is still used when no date can be parsed)
+HEAD_FREE_DATES = False
+
+# Keep the Last-Modified and size of documents (from HEAD requests) in the
+# scraper state for this number of seconds, so that documents which did not
+# make it to event data are not requested again by the next runs. 0 to disable.
+HEAD_CACHE_TTL = 86400 * 7
+
+# Keep the documents in a compact form while they are in flight: a slotted
+# record until their headers are received, only the headers used by the scraper,
+# and the full text of their box (full_info) only for the items with errors
+# (reported in the mail)
+COMPACT_ITEMS = True
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-# }
+EXTENSIONS = {
+    # "scrapy.extensions.telnet.TelnetConsole": None,
+    # Replaced by SlotAutoThrottle, with the same AUTOTHROTTLE_* settings
+    "scrapy.extensions.throttle.AutoThrottle": None,
+    "scraper.extensions.SlotAutoThrottle": 0,
+    "scraper.extensions.RunMetrics": 500,
+}
+
+# Write the metrics of the run (pages, bytes, HEAD requests, skipped documents,
+# drops, uploads and their latency, AutoThrottle delays, close reason) to a
+# JSON file, and optionally to a Prometheus textfile
+RUN_METRICS_ENABLED = True
+RUN_METRICS_PATH = "run_metrics.json"
+RUN_METRICS_PROMETHEUS_PATH = None
+# Interval (seconds) between samples of the download delays
+RUN_METRICS_SAMPLE_INTERVAL = 60
+# Also upload the JSON file to the add-on run, in the archive of the run files
+RUN_METRICS_UPLOAD = False
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
@@ -83,6 +144,76 @@ ITEM_PIPELINES = {
     "scraper.pipelines.MailPipeline": 999,
 }
 
+# Number of items with and without errors listed in full in the mail report.
+# The complete list is uploaded to the add-on run as a compressed CSV file (in
+# the archive of the run files).
+MAIL_REPORT_MAX_ITEMS = 200
+
+# Write the report to this JSON file instead of sending it (set for the shards
+# of a sharded run, whose reports are merged and sent by the parent process)
+MAIL_REPORT_PATH = None
+
+# Record the latency of each pipeline (count, total, p50, p95, max, drops) in
+# the stats (pipeline/<name>/...), reported in the log and the mail
+PIPELINE_STATS_ENABLED = False
+
+# Size of the LRU cache of the departments derived from the project name,
+# shared by the documents of a project. Set to 0 to disable it.
+ENRICHMENT_CACHE_SIZE = 1024
+
+# Number of worker threads uploading documents to DocumentCloud, so that API
+# round-trips do not block the crawl. Set to 0 to upload synchronously.
+UPLOAD_CONCURRENCY = 4
+
+# Maximum number of documents uploaded per minute, across all the shards of a
+# sharded run. Set to 0 for no limit.
+UPLOAD_RATE_LIMIT = 0
+
+# Buffer documents and create them in bulk, up to 25 per DocumentCloud API call.
+# A batch is uploaded when full, or UPLOAD_BATCH_MAX_AGE seconds after its
+# first document. Set to 0 to upload documents one by one.
+UPLOAD_BATCH_SIZE = 0
+UPLOAD_BATCH_MAX_AGE = 30
+
+# Keep the URLs of the documents pages found by crawling the site (for the same
+# target years) for NAV_MAP_TTL seconds, and request them directly instead of
+# going through the navigation pages. The site is crawled again from START_URL
+# once the map expires, or if one of its pages is not found. Set to 0 to crawl
+# the navigation pages on each run.
+NAV_MAP_TTL = 86400
+
+# Stop scheduling requests TIME_LIMIT_MARGIN seconds before the time limit of
+# the run, so that the requests and uploads in progress can finish and the
+# documents left can be saved in a checkpoint, resumed by the next run.
+TIME_LIMIT_MARGIN = 300
+
+# Save the pages not parsed yet in the checkpoint when a run is interrupted by
+# the time or upload limit. The next run with the same name and target years
+# resumes from them instead of crawling the site again from START_URL.
+RESUME_FRONTIER = True
+
+# Store event data on DocumentCloud every EVENT_DATA_STORE_EVERY uploads, or
+# every EVENT_DATA_STORE_INTERVAL seconds, instead of after each upload.
+# Pending updates are always stored when the spider closes.
+EVENT_DATA_STORE_EVERY = 25
+EVENT_DATA_STORE_INTERVAL = 300
+
+# For dry runs and local runs, keep event data on disk as a snapshot
+# (event_data.json) plus an append-only journal (event_data.json.log), merged
+# into the snapshot once it has more than EVENT_DATA_JOURNAL_COMPACT_AFTER
+# records. Set to False to rewrite event_data.json at the end of each run.
+EVENT_DATA_JOURNAL = True
+EVENT_DATA_JOURNAL_COMPACT_AFTER = 1000
+
+# Where the event data lives during a run: "dict" (in memory) or "sqlite". With
+# "sqlite", the seen documents are kept in EVENT_DATA_SQLITE_PATH, indexed by
+# URL, target year, source page and last modified date, and written in
+# transactions of EVENT_DATA_SQLITE_BATCH_SIZE records. Local runs then use the
+# database instead of event_data.json.
+EVENT_DATA_BACKEND = "dict"
+EVENT_DATA_SQLITE_PATH = "event_data.sqlite3"
+EVENT_DATA_SQLITE_BATCH_SIZE = 100
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 AUTOTHROTTLE_ENABLED = True
@@ -0,0 +1,283 @@
+"""Sharded runs: several spiders in separate processes, over parts of the years
+or categories, sharing the upload rate limit."""
+
+import gzip
+import shutil
+import time
+
+from .instrumentation import STATS_PREFIX, merge_pipeline_stats
+from .persistence import STATE_KEY
+
+# Groups of categories (prefixes of category_local) of the categories shards
+CATEGORY_GROUPS = ["Avis rendus", "Décisions de cas par cas", "Saisines"]
+
+
+def split_years(target_years, shards):
+    """Splits the target years in up to `shards` ranges of consecutive years."""
+
+    years = list(target_years)
+    shards = max(min(shards, len(years)), 1)
+    size, extra = divmod(len(years), shards)
+
+    ranges = []
+    start = 0
+    for index in range(shards):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(range(years[start], years[end - 1] + 1))
+        start = end
+
+    return ranges
+
+
+def make_shards(target_years, shards, shard_by="years"):
+    """Returns the shards of a run, as dicts with their name, target years and
+    categories (None for all categories)."""
+
+    if shard_by == "categories":
+        shards = max(min(shards, len(CATEGORY_GROUPS)), 1)
+        return [
+            {
+                "name": " + ".join(CATEGORY_GROUPS[index::shards]),
+                "target_years": target_years,
+                "categories": CATEGORY_GROUPS[index::shards],
+            }
+            for index in range(shards)
+        ]
+
+    return [
+        {
+            "name": f"{years[0]}-{years[-1]}" if len(years) > 1 else str(years[0]),
+            "target_years": years,
+            "categories": None,
+        }
+        for years in split_years(target_years, shards)
+    ]
+
+
+def partition_event_data(event_data, shard):
+    """The event data of the documents of a shard (all of them for the
+    categories shards, as event data does not record categories)."""
+
+    if shard["categories"]:
+        return dict(event_data)
+
+    target_years = [str(y) for y in shard["target_years"]]
+
+    return {
+        url: record
+        for url, record in event_data.items()
+        if str(record.get("target_year")) in target_years
+    }
+
+
+def shard_state(state, shard):
+    """The scraper state given to a shard: the caches of the whole run, and the
+    checkpoint of the shard."""
+
+    checkpoint = state.get("shard_checkpoints", {}).get(shard["name"])
+
+    state = {
+        key: value
+        for key, value in state.items()
+        if key not in ("checkpoint", "shard_checkpoints")
+    }
+    if checkpoint:
+        state["checkpoint"] = checkpoint
+
+    return state
+
+
+def merge_event_data(event_data, shard_event_data):
+    """Adds the documents recorded by the shards to the event data."""
+
+    merged = dict(event_data)
+
+    for shard_data in shard_event_data:
+        for url, record in shard_data.items():
+            if url != STATE_KEY and event_data.get(url) != record:
+                merged[url] = record
+
+    return merged
+
+
+def merge_scraper_states(state, shards, shard_states):
+    """Merges the caches of the scraper states of the shards (dicts of page or
+    document URLs), and keeps the checkpoint of each shard apart."""
+
+    merged = dict(state)
+    checkpoints = dict(merged.get("shard_checkpoints", {}))
+
+    for shard, shard_state in zip(shards, shard_states):
+        for key, value in shard_state.items():
+            if key == "checkpoint":
+                continue
+            if isinstance(value, dict):
+                merged[key] = {**merged.get(key, {}), **value}
+            else:
+                merged[key] = value
+
+        # Entries dropped by the shard (expired, or resolved), as each shard
+        # was given all the caches
+        for key, value in state.items():
+            if key in ("checkpoint", "shard_checkpoints"):
+                continue
+            if isinstance(value, dict) and key in merged:
+                removed = value.keys() - shard_state.get(key, {}).keys()
+                merged[key] = {
+                    url: entry
+                    for url, entry in merged[key].items()
+                    if url not in removed
+                }
+                if not merged[key]:
+                    del merged[key]
+
+        if shard_state.get("checkpoint"):
+            checkpoints[shard["name"]] = shard_state["checkpoint"]
+        else:
+            checkpoints.pop(shard["name"], None)
+
+    if checkpoints:
+        merged["shard_checkpoints"] = checkpoints
+    else:
+        merged.pop("shard_checkpoints", None)
+
+    return merged
+
+
+def sum_values(values):
+    """Sums numbers and dicts of numbers, or returns the first value."""
+
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+
+    if all(
+        isinstance(value, (int, float)) and not isinstance(value, bool)
+        for value in values
+    ):
+        return round(sum(values), 3)
+
+    if all(isinstance(value, dict) for value in values):
+        keys = []
+        for value in values:
+            keys.extend(key for key in value if key not in keys)
+        return {key: sum_values([value.get(key) for value in values]) for key in keys}
+
+    return values[0]
+
+
+def merge_stats(shard_stats):
+    """Sums the numeric crawler stats of the shards, and merges their pipeline
+    stats (see merge_pipeline_stats)."""
+
+    return {
+        **{
+            key: value
+            for key, value in sum_values(shard_stats).items()
+            if isinstance(value, (int, float)) and not key.startswith(STATS_PREFIX)
+        },
+        **merge_pipeline_stats(shard_stats),
+    }
+
+
+def merge_metrics(shard_metrics):
+    """Merges the run metrics (RunMetrics) of the shards; the metrics of each
+    shard are kept under "shards"."""
+
+    merged = sum_values(shard_metrics)
+
+    merged["elapsed_seconds"] = max(m["elapsed_seconds"] for m in shard_metrics)
+    merged["finished_at"] = max(m["finished_at"] for m in shard_metrics)
+    merged["target_years"] = [
+        min(m["target_years"][0] for m in shard_metrics),
+        max(m["target_years"][-1] for m in shard_metrics),
+    ]
+    merged["close_reason"] = next(
+        (m["close_reason"] for m in shard_metrics if m["close_reason"] != "finished"),
+        "finished",
+    )
+    merged["uploads_per_minute"] = (
+        round(merged["uploads"] / merged["elapsed_seconds"] * 60, 2)
+        if merged["elapsed_seconds"]
+        else 0
+    )
+    merged.pop("download_delays", None)
+    merged["shards"] = shard_metrics
+
+    return merged
+
+
+def merge_reports(reports, list_path, max_items):
+    """Merges the mail reports (MailPipeline.report) of the shards, and their
+    compressed CSV lists into `list_path`."""
+
+    counts = {}
+    for report in reports:
+        for category, year, ok, errors in report["counts"]:
+            count = counts.setdefault((category, year), [0, 0])
+            count[0] += ok
+            count[1] += errors
+
+    with gzip.open(list_path, "wt", newline="") as merged_list:
+        for index, report in enumerate(reports):
+            with gzip.open(report["list_path"], "rt", newline="") as shard_list:
+                header = shard_list.readline()
+                if index == 0:
+                    merged_list.write(header)
+                shutil.copyfileobj(shard_list, merged_list)
+
+    return {
+        "count_ok": sum(report["count_ok"] for report in reports),
+        "count_with_error": sum(report["count_with_error"] for report in reports),
+        "items_ok": [item for report in reports for item in report["items_ok"]][
+            :max_items
+        ],
+        "items_with_error": [
+            item for report in reports for item in report["items_with_error"]
+        ][:max_items],
+        "counts": [
+            [category, year, ok, errors]
+            for (category, year), (ok, errors) in counts.items()
+        ],
+        "list_path": list_path,
+    }
+
+
+class UploadRateLimiter:
+    """Limits the uploads to DocumentCloud to `rate` documents per minute, across
+    the processes of a sharded run (blocking)."""
+
+    def __init__(self, rate, context):
+        self.interval = 60 / rate
+        # Time from which the next upload may start
+        self.next_upload = context.Value("d", 0.0)
+
+    def reserve(self, documents=1):
+        """Reserves the uploads of `documents` documents. Returns the number of
+        seconds to wait before they may start."""
+
+        with self.next_upload.get_lock():
+            now = time.time()
+            start = max(now, self.next_upload.value)
+            self.next_upload.value = start + documents * self.interval
+
+        return start - now
+
+    def wait(self, documents=1):
+        """Waits until `documents` documents may be uploaded."""
+
+        delay = self.reserve(documents)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class SharedCounter:
+    """Counter shared by the processes of a sharded run."""
+
+    def __init__(self, context):
+        self.value = context.Value("i", 0)
+
+    def increment(self):
+        with self.value.get_lock():
+            self.value.value += 1
+            return self.value.value
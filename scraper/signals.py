@@ -0,0 +1,9 @@
+"""Custom signals of the scraper."""
+
+# Sent when all the new documents of a documents page were processed
+# (added to event data). Arguments: page_url
+page_completed = object()
+
+# Sent when a document was uploaded to DocumentCloud.
+# Arguments: item, latency (seconds)
+document_uploaded = object()
@@ -1,12 +1,106 @@
+import hashlib
+import posixpath
 import re
+from collections import defaultdict
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
 
 import scrapy
-from scrapy.exceptions import CloseSpider
-
-from ..items import DocumentItem
-
-AUTHORITY = "IGEDD"
+from scrapy import signals
+from scrapy.exceptions import CloseSpider, IgnoreRequest
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.defer import deferred_from_coro
+from w3lib.url import canonicalize_url
+
+from ..extraction import extract_documents
+from ..instrumentation import PipelineStats
+from ..items import DOCUMENT_HEADERS, DocumentItem, DocumentRecord, document_item
+from ..signals import page_completed
+
+# Request priorities (navigation pages have the default priority, 0)
+PRIORITY_HEAD = 10
+PRIORITY_DOCUMENTS_PAGE = 20
+
+# Fields of the documents saved in the checkpoint (set before their headers
+# are requested, plus the Last-Modified date if it was already known). The text
+# of their box (full_info) is left out: it is large, and only reported in the
+# mail for the items with errors.
+CHECKPOINT_FIELDS = [
+    "title",
+    "project",
+    "authority",
+    "category_local",
+    "source_file_url",
+    "source_page_url",
+    "year",
+    "publication_lastmodified",
+]
+
+MONTHS = {
+    "janvier": 1,
+    "février": 2,
+    "fevrier": 2,
+    "mars": 3,
+    "avril": 4,
+    "mai": 5,
+    "juin": 6,
+    "juillet": 7,
+    "août": 8,
+    "aout": 8,
+    "septembre": 9,
+    "octobre": 10,
+    "novembre": 11,
+    "décembre": 12,
+    "decembre": 12,
+}
+
+
+def parse_listing_date(date_string):
+    """Parse a date written on a listing page ("10 janvier 2024", "1er mars 2024"
+    or "10/01/2024"). Returns a datetime, or None if no date could be parsed."""
+
+    match = re.search(
+        rf"(\d{{1,2}})(?:er)?\s+({'|'.join(MONTHS)})\s+(20\d\d)",
+        date_string,
+        re.IGNORECASE,
+    )
+    if match:
+        day, month, year = match.groups()
+        month = MONTHS[month.lower()]
+    else:
+        match = re.search(r"(\d{1,2})/(\d{1,2})/(20\d\d)", date_string)
+        if not match:
+            return None
+        day, month, year = match.groups()
+
+    try:
+        return datetime(int(year), int(month), int(day))
+    except ValueError:
+        return None
+
+
+def head_cache_expired(cached, ttl):
+    """Whether headers of the head cache were fetched more than `ttl` seconds ago."""
+
+    age = datetime.now() - datetime.fromisoformat(cached["fetched_at"])
+    return timedelta.total_seconds(age) > ttl
+
+
+def normalize_url(url):
+    """Normalize the URL of a document, so that a document listed more than once
+    is recognized under the different forms of its URL: same for http and https,
+    with or without the default port, dot segments resolved, query arguments
+    sorted and fragment removed."""
+
+    parts = urlsplit(canonicalize_url(url))
+
+    netloc = parts.hostname or ""
+    if parts.port and parts.port not in (80, 443):
+        netloc += f":{parts.port}"
+    path = posixpath.normpath(parts.path) if parts.path else "/"
+    query = f"?{parts.query}" if parts.query else ""
+
+    return netloc + path + query
 
 
 class IGEDDSpider(scrapy.Spider):
@@ -23,27 +117,665 @@ class IGEDDSpider(scrapy.Spider):
     ]
 
     upload_limit_attained = False
+    time_limit_attained = False
+
+    time_limit = 0
+
+    # Categories to crawl (prefixes of category_local), None for all of them
+    categories = None
+
+    # Shared by the processes of a sharded run
+    upload_counter = None
+    upload_rate_limiter = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.start_urls = [crawler.settings.get("START_URL", cls.start_urls[0])]
+        # Latency of the item pipelines, timed when they are created
+        spider.pipeline_stats = (
+            PipelineStats()
+            if crawler.settings.getbool("PIPELINE_STATS_ENABLED")
+            else None
+        )
+        crawler.signals.connect(spider.start_time_budget, signal=signals.spider_opened)
+        return spider
+
+    @classmethod
+    def update_settings(cls, settings):
+        super().update_settings(settings)
+
+        if settings.getbool("BREADTH_FIRST"):
+            # https://docs.scrapy.org/en/latest/faq.html#does-scrapy-crawl-in-breadth-first-or-depth-first-order
+            settings.set("DEPTH_PRIORITY", 1, priority="spider")
+            settings.set(
+                "SCHEDULER_DISK_QUEUE",
+                "scrapy.squeues.PickleFifoDiskQueue",
+                priority="spider",
+            )
+            settings.set(
+                "SCHEDULER_MEMORY_QUEUE",
+                "scrapy.squeues.FifoMemoryQueue",
+                priority="spider",
+            )
 
-    start_time = datetime.now()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # New documents (not in event data yet) of each documents page
+        self.pending_documents = defaultdict(set)
+        self.parsed_pages = set()
+
+        # Content fingerprints of the documents pages parsed during this run
+        self.page_fingerprints = {}
+
+        # Documents followed during this run and not in event data yet, and
+        # pages requested but not parsed yet (the frontier), saved in the
+        # checkpoint when the spider closes
+        self.followed_documents = {}
+        self.resumed_documents = set()
+        # Documents followed during this run, by normalized URL: URL of the
+        # first one followed, and the documents pages listing it
+        self.seen_documents = {}
+        # Normalized URLs of the documents in event data at the start of the run
+        self.event_data_keys = None
+        self.frontier_pages = {}
+        self.frontier_resumed = False
+
+        # Documents pages found during this run, saved in the navigation map
+        self.documents_pages = {}
+        self.nav_map_used = False
+        self.nav_map_invalidated = False
+
+        # Files to upload to the add-on run once the run is over
+        self.run_files = []
+
+        self.start_time = datetime.now()
+        self.time_budget_call = None
+
+    async def start(self):
+        # Only requests are yielded from start(): the engine does not wait for
+        # the items, so the documents resumed with their date are yielded by
+        # the callback of a request instead
+        documents = []
+        for item_or_request in self.resume_checkpoint():
+            if isinstance(item_or_request, scrapy.Request):
+                yield item_or_request
+            else:
+                documents.append(item_or_request)
+
+        if documents:
+            yield self.documents_request(documents)
+
+        if self.frontier_resumed:
+            return
+
+        nav_map = self.cached_nav_map()
+        if nav_map:
+            # Skip the navigation pages
+            self.nav_map_used = True
+            self.crawler.stats.set_value("nav_map/pages", len(nav_map["pages"]))
+            self.logger.info(
+                f"Requesting the {len(nav_map['pages'])} documents pages of the navigation map (built at {nav_map['built_at']})"
+            )
+            for page in nav_map["pages"]:
+                request = self.page_request(page)
+                request.meta["nav_map"] = True
+                yield self.follow_page(request)
+            return
+
+        async for request in super().start():
+            yield self.follow_page(request)
+
+    def documents_request(self, documents):
+        """A request (to a data: URL, not downloaded) whose callback yields
+        documents that are ready to be processed."""
+
+        return scrapy.Request(
+            "data:,",
+            callback=self.yield_documents,
+            cb_kwargs=dict(documents=documents),
+            priority=self.priority("head"),
+            dont_filter=True,
+        )
+
+    def yield_documents(self, response, documents):
+        yield from documents
+
+    def priority(self, request_type, link_text=None):
+        """Priority of a request, so that documents are uploaded before the whole
+        site is crawled (documents pages first, newest year first, then HEAD
+        requests of documents, then navigation pages), or 0 with BREADTH_FIRST."""
+
+        if self.settings.getbool("BREADTH_FIRST"):
+            return 0
+
+        if request_type == "documents_page":
+            year_match = re.search(r"20\d\d", link_text or "")
+            year = int(year_match.group()) if year_match else self.target_years[-1]
+            return PRIORITY_DOCUMENTS_PAGE + year - self.target_years[0]
+
+        elif request_type == "head":
+            return PRIORITY_HEAD
+
+        return 0
+
+    def page_key(self, url):
+        """Key of a documents page in the caches of the scraper state.
+
+        The documents followed on a page depend on the target years.
+        """
+        return f"{url} {self.target_years[0]}-{self.target_years[-1]}"
+
+    def follows_category(self, category_local):
+        """Checks if the pages of a category are crawled (sharded runs)."""
+
+        return not self.categories or any(
+            category_local.startswith(category) for category in self.categories
+        )
+
+    def checkpoint_key(self):
+        """Key of the run in the checkpoint: the frontier of an interrupted run is
+        resumed by the next run with the same name and target years."""
+
+        return f"{self.run_name} {self.target_years[0]}-{self.target_years[-1]}"
+
+    def nav_map_key(self):
+        """Key of the navigation map: the documents pages followed depend on the
+        target years and categories."""
+
+        key = f"{self.target_years[0]}-{self.target_years[-1]}"
+        if self.categories:
+            key += " " + ", ".join(self.categories)
+        return key
+
+    def cached_nav_map(self):
+        """Returns the navigation map built by a previous run, unless it is older
+        than NAV_MAP_TTL seconds."""
+
+        ttl = self.settings.getint("NAV_MAP_TTL")
+        if not ttl:
+            return None
+
+        nav_maps = self.scraper_state.setdefault("nav_maps", {})
+        nav_map = nav_maps.get(self.nav_map_key())
+        if not nav_map:
+            return None
+
+        age = datetime.now() - datetime.fromisoformat(nav_map["built_at"])
+        if timedelta.total_seconds(age) > ttl:
+            del nav_maps[self.nav_map_key()]
+            self.crawler.stats.inc_value("nav_map/expired")
+            return None
+
+        return nav_map
+
+    def save_nav_map(self):
+        """Saves the documents pages found by crawling the site from START_URL,
+        if all the navigation pages were parsed.
+
+        Returns True if the scraper state needs to be stored.
+        """
+
+        if (
+            not self.settings.getint("NAV_MAP_TTL")
+            or self.nav_map_used
+            or self.frontier_resumed
+            or not self.documents_pages
+        ):
+            return False
+
+        for page in self.frontier_pages.values():
+            if page["callback"] != "parse_documents_page":
+                # Navigation not complete
+                return False
+
+        self.scraper_state.setdefault("nav_maps", {})[self.nav_map_key()] = {
+            "built_at": datetime.now().isoformat(timespec="seconds"),
+            "pages": list(self.documents_pages.values()),
+        }
+        self.crawler.stats.set_value("nav_map/saved", len(self.documents_pages))
+        return True
+
+    def page_request(self, page):
+        """Request of a page saved in the frontier or navigation map."""
+
+        return scrapy.Request(
+            page["url"],
+            callback=getattr(self, page["callback"]),
+            cb_kwargs=page["cb_kwargs"],
+            meta=page["meta"],
+            priority=page["priority"],
+        )
+
+    def follow_page(self, request):
+        """Adds the request of a page to the frontier until it is parsed."""
+
+        page = {
+            "url": request.url,
+            "callback": (request.callback or self.parse).__name__,
+            "cb_kwargs": dict(request.cb_kwargs),
+            "meta": {
+                key: value
+                for key, value in request.meta.items()
+                if key not in ("nav_map", "frontier_url")
+            },
+            "priority": request.priority,
+        }
+
+        self.frontier_pages[request.url] = page
+        if page["callback"] == "parse_documents_page":
+            self.documents_pages[request.url] = page
+
+        return request.replace(
+            errback=self.page_error,
+            meta={**request.meta, "frontier_url": request.url},
+        )
+
+    def page_done(self, request):
+        """Removes a page from the frontier once it is parsed."""
+
+        self.frontier_pages.pop(request.meta.get("frontier_url", request.url), None)
+
+    def page_error(self, failure):
+        if failure.check(IgnoreRequest) and not failure.check(HttpError):
+            # Not modified since the last run
+            self.page_done(failure.request)
+            return None
+
+        if (
+            failure.request.meta.get("nav_map")
+            and failure.check(HttpError)
+            and failure.value.response.status == 404
+        ):
+            return self.rebuild_nav_map(failure.request)
+
+        # Kept in the frontier, and logged as usual
+        return failure
+
+    def rebuild_nav_map(self, request):
+        """A page of the navigation map was not found: drops the map and crawls
+        the site again from START_URL."""
+
+        self.logger.warning(
+            f"Page of the navigation map not found ({request.url}), crawling the site again"
+        )
+        self.page_done(request)
+        self.scraper_state.get("nav_maps", {}).pop(self.nav_map_key(), None)
+        self.documents_pages = {}
+
+        if self.nav_map_invalidated:
+            return []
+
+        self.nav_map_invalidated = True
+        self.nav_map_used = False
+        self.crawler.stats.inc_value("nav_map/rebuilt")
+
+        return [
+            self.follow_page(scrapy.Request(url, dont_filter=True))
+            for url in self.start_urls
+        ]
+
+    def document(self, fields):
+        """A document found by the spider, as a DocumentRecord with
+        COMPACT_ITEMS (made an item when it is yielded), else a DocumentItem."""
+
+        if self.settings.getbool("COMPACT_ITEMS"):
+            return DocumentRecord(**fields)
+        return DocumentItem(**fields)
+
+    def follow_document(self, doc_item, listing_date=None):
+        """Request the headers of a document, unless it is already in event data
+        or was already followed during this run (under the same normalized URL,
+        in both cases).
+
+        With HEAD_FREE_DATES, the date written on the listing page (if any) is
+        used instead of the Last-Modified header, and the document is yielded
+        directly.
+        """
+
+        if doc_item["source_file_url"] in self.event_data:
+            self.crawler.stats.inc_value("documents/already_seen")
+            return
+
+        key = normalize_url(doc_item["source_file_url"])
+        if self.in_event_data(key):
+            # Uploaded by a previous run under another variant of its URL
+            self.crawler.stats.inc_value("documents/already_seen")
+            return
+
+        if key in self.seen_documents:
+            # Already followed during this run: from the checkpoint, or listed
+            # twice (in the same box, or on another page)
+            if doc_item["source_file_url"] not in self.resumed_documents:
+                self.crawler.stats.inc_value("documents/duplicate_candidates")
+
+            url, pages = self.seen_documents[key]
+            pages.add(doc_item["source_page_url"])
+            if url not in self.event_data:
+                self.pending_documents[doc_item["source_page_url"]].add(url)
+            return
+
+        self.seen_documents[key] = (
+            doc_item["source_file_url"],
+            {doc_item["source_page_url"]},
+        )
+        self.pending_documents[doc_item["source_page_url"]].add(
+            doc_item["source_file_url"]
+        )
+
+        self.followed_documents[doc_item["source_file_url"]] = doc_item
+
+        if doc_item.get("publication_lastmodified"):
+            # Resumed from the checkpoint with its date
+            yield document_item(doc_item)
+            return
+
+        if listing_date and self.settings.getbool("HEAD_FREE_DATES"):
+            date = parse_listing_date(listing_date)
+            if date:
+                doc_item["publication_lastmodified"] = date.strftime(
+                    "%a, %d %b %Y %H:%M:%S GMT"
+                )
+                self.crawler.stats.inc_value("head/avoided")
+                yield document_item(doc_item)
+                return
+
+            self.logger.debug(f"Could not parse listing date '{listing_date}'")
+
+        cached = self.cached_headers(doc_item["source_file_url"])
+        if cached:
+            doc_item["headers"] = {
+                "Last-Modified": cached["last_modified"],
+                "Content-Length": cached["size"],
+            }
+            doc_item["publication_lastmodified"] = cached["last_modified"]
+            self.crawler.stats.inc_value("head_cache/hit")
+            yield document_item(doc_item)
+            return
+
+        yield scrapy.Request(
+            doc_item["source_file_url"],
+            method="HEAD",
+            callback=self.parse_document_headers,
+            errback=self.document_headers_error,
+            cb_kwargs=dict(doc_item=doc_item),
+            priority=self.priority("head"),
+        )
+
+    def in_event_data(self, key):
+        """Whether a document with this normalized URL was uploaded by a
+        previous run. The normalized URLs of event data are listed the first
+        time a document is followed."""
+
+        if self.event_data_keys is None:
+            self.event_data_keys = {normalize_url(url) for url in self.event_data}
+        return key in self.event_data_keys
+
+    def resume_checkpoint(self):
+        """Follows the documents saved in the checkpoint by the previous run
+        (stopped by the time or upload limit) before crawling the site.
+
+        If the previous run had the same name and target years, its frontier is
+        followed too, instead of crawling the site again from START_URL.
+        """
+
+        checkpoint = self.scraper_state.pop("checkpoint", {})
+        target_years = [str(y) for y in self.target_years]
+
+        if (
+            self.settings.getbool("RESUME_FRONTIER")
+            and checkpoint.get("key") == self.checkpoint_key()
+            and "pages" in checkpoint
+        ):
+            self.frontier_resumed = True
+            self.crawler.stats.set_value(
+                "checkpoint/pages_resumed", len(checkpoint["pages"])
+            )
+            self.logger.info(
+                f"Resuming the crawl of the previous run ({len(checkpoint['pages'])} pages left)"
+            )
 
-    def check_time_limit(self):
-        """Closes the spider automatically if it reaches a specified duration"""
+            for page in checkpoint["pages"]:
+                yield self.follow_page(self.page_request(page))
 
-        # self.logger.info(f"Checking time limit ({self.time_limit} min)")
+        for document in checkpoint.get("documents", []):
+            if document["year"] not in target_years:
+                continue
 
-        if self.time_limit != 0:
+            doc_item = self.document(document)
+            self.crawler.stats.inc_value("checkpoint/resumed")
+            yield from self.follow_document(doc_item)
+            self.resumed_documents.add(doc_item["source_file_url"])
 
-            limit = self.time_limit * 60
-            now = datetime.now()
+        if checkpoint.get("documents"):
+            self.logger.info(
+                f"Resuming {self.crawler.stats.get_value('checkpoint/resumed', 0)} documents from the checkpoint of the previous run"
+            )
 
-            if timedelta.total_seconds(now - self.start_time) > limit:
-                raise CloseSpider(
-                    f"Closed due to time limit ({self.time_limit} minutes)"
-                )
+    def save_checkpoint(self):
+        """Saves the documents followed but not added to event data (time or
+        upload limit, upload errors) in the scraper state, for the next run.
+
+        If the run was interrupted, the pages not parsed yet are saved too, so
+        that a backfill can span several runs.
+
+        Returns True if the scraper state needs to be stored.
+        """
+
+        documents = [
+            {
+                field: doc_item[field]
+                for field in CHECKPOINT_FIELDS
+                if doc_item.get(field) is not None
+            }
+            for doc_item in self.followed_documents.values()
+        ]
+        checkpoint = {"key": self.checkpoint_key(), "documents": documents}
+
+        interrupted = self.time_limit_attained or self.upload_limit_attained
+        if interrupted and self.settings.getbool("RESUME_FRONTIER"):
+            checkpoint["pages"] = list(self.frontier_pages.values())
+            self.crawler.stats.set_value(
+                "checkpoint/pages_saved", len(self.frontier_pages)
+            )
+
+        self.crawler.stats.set_value("checkpoint/saved", len(documents))
+
+        if not documents and "pages" not in checkpoint:
+            return self.scraper_state.pop("checkpoint", None) is not None
+
+        self.scraper_state["checkpoint"] = checkpoint
+        self.logger.info(
+            f"Saved {len(documents)} pending documents and {len(checkpoint.get('pages', []))} pending pages in the checkpoint for the next run"
+        )
+        return True
+
+    def cached_headers(self, url):
+        """Returns the headers of a document cached by a previous run, unless
+        they are older than HEAD_CACHE_TTL seconds."""
+
+        ttl = self.settings.getint("HEAD_CACHE_TTL")
+        if not ttl:
+            return None
+
+        head_cache = self.scraper_state.setdefault("head_cache", {})
+        cached = head_cache.get(url)
+        if not cached:
+            return None
+
+        if head_cache_expired(cached, ttl):
+            del head_cache[url]
+            return None
+
+        return cached
+
+    def prune_head_cache(self):
+        """Drops the expired headers from the head cache (all of them if it is
+        disabled), so that it does not grow with each run.
+
+        Returns True if the scraper state needs to be stored.
+        """
+
+        head_cache = self.scraper_state.get("head_cache")
+        if not head_cache:
+            return False
+
+        ttl = self.settings.getint("HEAD_CACHE_TTL")
+        expired = [
+            url
+            for url, cached in head_cache.items()
+            if not ttl or head_cache_expired(cached, ttl)
+        ]
+        for url in expired:
+            del head_cache[url]
+        if not head_cache:
+            del self.scraper_state["head_cache"]
+
+        self.crawler.stats.set_value("head_cache/pruned", len(expired))
+        return bool(expired)
+
+    def page_parsed(self, page_url):
+        """Called once all the documents of a documents page were followed."""
+
+        self.parsed_pages.add(page_url)
+        self.check_page_completed(page_url)
+
+    def document_done(self, doc_item):
+        """Called once a document was added to event data."""
+
+        # Documents in event data are not requested again
+        self.scraper_state.get("head_cache", {}).pop(doc_item["source_file_url"], None)
+
+        self.followed_documents.pop(doc_item["source_file_url"], None)
+
+        # The pages listing the document (more than one if it was listed again)
+        _, pages = self.seen_documents.get(
+            normalize_url(doc_item["source_file_url"]),
+            (None, {doc_item["source_page_url"]}),
+        )
+        for page_url in pages:
+            self.pending_documents[page_url].discard(doc_item["source_file_url"])
+            self.check_page_completed(page_url)
+
+    def document_headers_error(self, failure):
+        """The HEAD request of a document failed (after its retries).
+
+        The document stays pending, so that the pages listing it are not
+        completed (their fingerprints and validators are not saved) and are
+        parsed again by the next run. It is kept in the checkpoint too, unless
+        it was not found.
+        """
+
+        url = failure.request.cb_kwargs["doc_item"]["source_file_url"]
+
+        self.logger.warning(f"Could not get the headers of {url}: {failure.value!r}")
+        self.crawler.stats.inc_value("head/failed")
+
+        if failure.check(HttpError) and failure.value.response.status in (404, 410):
+            self.followed_documents.pop(url, None)
+
+    def check_page_completed(self, page_url):
+        """Sends page_completed once all new documents of a page are in event data."""
+
+        if page_url in self.parsed_pages and not self.pending_documents[page_url]:
+            if page_url in self.page_fingerprints:
+                self.scraper_state.setdefault("fingerprints", {})[
+                    self.page_key(page_url)
+                ] = self.page_fingerprints.pop(page_url)
+
+            self.crawler.signals.send_catch_log(page_completed, page_url=page_url)
+
+    def page_unchanged(self, response):
+        """Checks if the content of a documents page is the same as when all its
+        documents were last processed (SPIP pages often lack reliable validators)."""
+
+        if not self.settings.getbool("PAGE_FINGERPRINTS_ENABLED"):
+            return False
+
+        content = "".join(
+            response.css("#contenu .texte-article, #main .texte-article").getall()
+        )
+        fingerprint = hashlib.sha256(content.encode()).hexdigest()
+
+        page_url = response.request.url
+        cached = self.scraper_state.get("fingerprints", {}).get(self.page_key(page_url))
+
+        if cached == fingerprint:
+            return True
+
+        self.page_fingerprints[page_url] = fingerprint
+        return False
+
+    def time_budget(self):
+        """Seconds left before the spider must stop, to leave TIME_LIMIT_MARGIN
+        seconds before time_limit for in-flight requests and uploads, storing the
+        event data and sending the report. None without time limit."""
+
+        if not self.time_limit:
+            return None
+
+        elapsed = timedelta.total_seconds(datetime.now() - self.start_time)
+        margin = self.settings.getint("TIME_LIMIT_MARGIN")
+
+        return self.time_limit * 60 - margin - elapsed
+
+    def start_time_budget(self, spider):
+        """Schedules the end of the crawl when the time budget runs out, as
+        callbacks may not run for a while (e.g. only uploads left)."""
+        from twisted.internet import reactor
+
+        budget = self.time_budget()
+        if budget is not None:
+            self.time_budget_call = reactor.callLater(
+                max(budget, 0), self.time_budget_exhausted
+            )
+
+    def time_budget_exhausted(self):
+        """Stops scheduling requests and closes the spider once the requests
+        and uploads in progress are done."""
+
+        self.time_budget_call = None
+        self.time_limit_attained = True
+        self.logger.info(
+            f"Time budget exhausted ({self.time_limit} minutes, minus {self.settings.getint('TIME_LIMIT_MARGIN')} seconds of margin), closing the spider"
+        )
+
+        # Store pending event data now, before in-flight work is drained
+        self.event_data_persister.flush()
+        deferred_from_coro(
+            self.crawler.engine.close_spider_async(
+                reason=f"Closed due to time limit ({self.time_limit} minutes)"
+            )
+        )
+
+    def closed(self, reason):
+        if self.time_budget_call is not None and self.time_budget_call.active():
+            self.time_budget_call.cancel()
+
+    def attach_run_file(self, path, temporary=True):
+        """Adds a file to the archive uploaded to the add-on run at the end of
+        the run (an add-on run only keeps the last file uploaded). Temporary
+        files are deleted once uploaded."""
+
+        self.run_files.append({"path": path, "temporary": temporary})
+
+    def check_time_limit(self):
+        """Closes the spider if the time budget is exhausted (in case the
+        reactor was too busy to run the timer on time)."""
+
+        budget = self.time_budget()
+
+        if budget is not None and budget <= 0:
+            self.time_limit_attained = True
+            # Store pending event data now, before in-flight work is drained
+            self.event_data_persister.flush()
+            raise CloseSpider(f"Closed due to time limit ({self.time_limit} minutes)")
 
     def check_upload_limit(self):
         """Closes the spider if the upload limit is attained."""
         if self.upload_limit_attained:
+            self.event_data_persister.flush()
             raise CloseSpider("Closed due to max documents limit.")
 
     def parse(self, response):
@@ -58,12 +790,14 @@ class IGEDDSpider(scrapy.Spider):
                 link = section.css(".fr-tile__link")
 
                 title = link.css("::text").get()
-                if title == "Les saisines":
+                if title == "Les saisines" and self.follows_category("Saisines"):
 
-                    yield response.follow(
-                        link.attrib["href"],
-                        callback=self.parse_year_selection_page,
-                        cb_kwargs=dict(category_local="Saisines"),
+                    yield self.follow_page(
+                        response.follow(
+                            link.attrib["href"],
+                            callback=self.parse_year_selection_page,
+                            cb_kwargs=dict(category_local="Saisines"),
+                        )
                     )
 
             elif section.css(".rubrique_avec_sous-rubriques"):
@@ -71,7 +805,7 @@ class IGEDDSpider(scrapy.Spider):
                 title = section.css(".fr-tile__title::text").get().strip()
                 subsections = section.css(".lien-sous-rubrique")
 
-                if title == "Avis rendus":
+                if title == "Avis rendus" and self.follows_category("Avis rendus"):
 
                     current_year_subsec = subsections[0]
                     current_year_subsec_title = current_year_subsec.css("::text").get()
@@ -97,17 +831,21 @@ class IGEDDSpider(scrapy.Spider):
                         follow_archives = True
 
                     if follow_current:
-                        yield response.follow(
-                            current_year_subsec.attrib["href"],
-                            callback=self.parse_year_selection_page,
-                            cb_kwargs=dict(category_local="Avis rendus"),
+                        yield self.follow_page(
+                            response.follow(
+                                current_year_subsec.attrib["href"],
+                                callback=self.parse_year_selection_page,
+                                cb_kwargs=dict(category_local="Avis rendus"),
+                            )
                         )
 
                     if follow_archives:
-                        yield response.follow(
-                            archives_subsec.attrib["href"],
-                            callback=self.parse_year_selection_page,
-                            cb_kwargs=dict(category_local="Avis rendus"),
+                        yield self.follow_page(
+                            response.follow(
+                                archives_subsec.attrib["href"],
+                                callback=self.parse_year_selection_page,
+                                cb_kwargs=dict(category_local="Avis rendus"),
+                            )
                         )
 
                 elif title == "Examen au cas par cas et autres décisions":
@@ -116,14 +854,21 @@ class IGEDDSpider(scrapy.Spider):
                         link_url = subsec.attrib["href"]
                         link_text = subsec.css("::text").get()
 
+                        if not self.follows_category(link_text):
+                            continue
+
                         self.logger.debug(f"Following {link_text} / {link_url}")
 
-                        yield response.follow(
-                            link_url,
-                            callback=self.parse_current_or_archives_page,
-                            cb_kwargs=dict(category_local=link_text),
+                        yield self.follow_page(
+                            response.follow(
+                                link_url,
+                                callback=self.parse_current_or_archives_page,
+                                cb_kwargs=dict(category_local=link_text),
+                            )
                         )
 
+        self.page_done(response.request)
+
     def parse_current_or_archives_page(self, response, category_local):
         # https://www.igedd.developpement-durable.gouv.fr/decisions-de-cas-par-cas-sur-des-projets-r506.html
         # https://www.igedd.developpement-durable.gouv.fr/decisions-de-cas-par-cas-sur-des-plans-programmes-r507.html
@@ -154,19 +899,27 @@ class IGEDDSpider(scrapy.Spider):
             follow_archives = True
 
         if follow_current_year:
-            yield response.follow(
-                current_year_link.attrib["href"],
-                callback=self.parse_documents_page,
-                cb_kwargs=dict(category_local=category_local),
+            yield self.follow_page(
+                response.follow(
+                    current_year_link.attrib["href"],
+                    callback=self.parse_documents_page,
+                    cb_kwargs=dict(category_local=category_local),
+                    meta=dict(conditional_get=True),
+                    priority=self.priority("documents_page", current_year_link_text),
+                )
             )
 
         if follow_archives:
-            yield response.follow(
-                archives_link.attrib["href"],
-                callback=self.parse_year_selection_page,
-                cb_kwargs=dict(category_local=category_local),
+            yield self.follow_page(
+                response.follow(
+                    archives_link.attrib["href"],
+                    callback=self.parse_year_selection_page,
+                    cb_kwargs=dict(category_local=category_local),
+                )
             )
 
+        self.page_done(response.request)
+
     def parse_year_selection_page(self, response, category_local):
 
         self.check_upload_limit()
@@ -178,10 +931,16 @@ class IGEDDSpider(scrapy.Spider):
 
             card_link = card_links[0]
 
-            yield response.follow(
-                card_link.attrib["href"],
-                callback=self.parse_documents_page,
-                cb_kwargs=dict(category_local=category_local),
+            yield self.follow_page(
+                response.follow(
+                    card_link.attrib["href"],
+                    callback=self.parse_documents_page,
+                    cb_kwargs=dict(category_local=category_local),
+                    meta=dict(conditional_get=True),
+                    priority=self.priority(
+                        "documents_page", card_link.css("::text").get()
+                    ),
+                )
             )
 
         else:
@@ -195,12 +954,18 @@ class IGEDDSpider(scrapy.Spider):
                 if year_match:
                     if any([str(y) == year_match.group() for y in self.target_years]):
                         self.logger.debug(f"matched '{link_text}'")
-                        yield response.follow(
-                            link.attrib["href"],
-                            callback=self.parse_documents_page,
-                            cb_kwargs=dict(category_local=category_local),
+                        yield self.follow_page(
+                            response.follow(
+                                link.attrib["href"],
+                                callback=self.parse_documents_page,
+                                cb_kwargs=dict(category_local=category_local),
+                                meta=dict(conditional_get=True),
+                                priority=self.priority("documents_page", link_text),
+                            )
                         )
 
+        self.page_done(response.request)
+
     def parse_documents_page(self, response, category_local):
 
         # Avis rendus: https://www.igedd.developpement-durable.gouv.fr/2024-r708.html?lang=fr
@@ -234,233 +999,51 @@ class IGEDDSpider(scrapy.Spider):
 
         page_title = response.xpath("//title/text()").get().replace(" |  IGEDD", "")
 
-        self.logger.info(f'Parsing page "{page_title}"')
-
-        if category_local == "Avis rendus":
-
-            page_title = response.xpath("//title/text()").get()
-            page_year = re.search("20\d\d", page_title)[0]
-
-            content_elements = response.css(
-                "#contenu .contenu-article .texte-article > *"
-            )
-
-            for elem in content_elements:
-                if elem.css("h2"):
-                    decision_date_line = elem.css("h2::text").get()
-                    decision_date_string = decision_date_line.replace("Séance du ", "")
-
-                elif elem.css(".texteencadre-spip"):
+        if self.page_unchanged(response):
+            self.logger.info(f'Skipping unchanged page "{page_title}"')
+            self.crawler.stats.inc_value("fingerprint/pages_short_circuited")
+            self.page_done(response.request)
+            return
 
-                    encadre = elem.css(".texteencadre-spip")
-
-                    if encadre.css("a.fr-download__link"):
-
-                        # Extract document info and yield new request
-
-                        full_info = "".join(
-                            [
-                                x
-                                for x in encadre.css("::text").getall()
-                                if x != "NOUVEAU"
-                            ]
-                        )
-
-                        project = encadre.css(".fr-download__link ::text").get().strip()
-
-                        # no_dossier = parse_no_dossier(full_info, category_local)
-
-                        if "cadrage préalable" in project.lower():
-                            title = f"Cadrage préalable"
-                        else:
-                            title = f"Avis"
-
-                        doc_link = encadre.css("a.fr-download__link").attrib["href"]
-
-                        doc_item = DocumentItem(
-                            title=title,
-                            project=project,
-                            authority=AUTHORITY,
-                            category_local=category_local,
-                            source_file_url=response.urljoin(doc_link),
-                            source_page_url=response.request.url,
-                            full_info=full_info,
-                            year=page_year,
-                        )
-
-                        for y in self.target_years:
-                            if (
-                                str(y) in page_title
-                                and not doc_item["source_file_url"] in self.event_data
-                            ):
-                                doc_item["year"] = str(y)
-
-                                yield response.follow(
-                                    doc_item["source_file_url"],
-                                    method="HEAD",
-                                    callback=self.parse_document_headers,
-                                    cb_kwargs=dict(doc_item=doc_item),
-                                )
-
-        elif category_local.startswith("Décisions de cas par cas"):
-
-            page_title = response.xpath("//title/text()").get()
-            page_year = re.search("20\d\d", page_title)[0]
+        self.logger.info(f'Parsing page "{page_title}"')
 
-            content_elements = response.css(
-                "#contenu .contenu-article .texte-article > *"
+        for record in extract_documents(response, category_local, self.target_years):
+            listing_date = record.pop("listing_date", None)
+            yield from self.follow_document(
+                self.document(record), listing_date=listing_date
             )
 
-            section = "?"
-            for elem in content_elements:
-                if elem.css(
-                    "h2"
-                ):  # Used to detect pending/taken decisions, not used for now
-                    h2_text = elem.css("h2::text").get()
-
-                    if "en cours" in h2_text:
-                        section = "en cours"
-
-                    elif "décisions prises" in h2_text:
-                        section = "décisions prises"
-
-                elif elem.css(".texteencadre-spip"):
-
-                    encadre = elem.css(".texteencadre-spip")
-
-                    full_info = "".join(encadre.css("::text").getall())
-
-                    # no_dossier = parse_no_dossier(full_info, category_local)
-
-                    # Project
-                    project_link = encadre.css("a.spip_out::text")
-                    if project_link:
-                        project = project_link.get().strip()
-                    else:
-                        project_match = re.search(
-                            "Nom et formulaire du dossier : (.*)\n", full_info
-                        )
-                        if project_match:
-                            project = project_match.group(1).strip()
-                        else:
-                            project = "ERROR"
-
-                    # links in boxes (avis, recours, lettres, etc)
-                    box_links = encadre.css("a.fr-download__link")
-                    for link in box_links:
-                        link_url = link.attrib["href"]
-                        link_text = link.css("::text").get().strip()
-                        if link_text in ["OUI", "NON"]:
-                            title = f"Décision ({link_text})"
-                        else:
-                            title = link_text.strip()
-
-                        doc_item = DocumentItem(
-                            title=title,
-                            category_local=category_local,
-                            authority=AUTHORITY,
-                            full_info=full_info,
-                            project=project,
-                            source_page_url=response.request.url,
-                            source_file_url=response.urljoin(link_url),
-                            year=page_year,
-                        )
-
-                        if not doc_item["source_file_url"] in self.event_data:
-                            yield response.follow(
-                                doc_item["source_file_url"],
-                                method="HEAD",
-                                callback=self.parse_document_headers,
-                                cb_kwargs=dict(doc_item=doc_item),
-                            )
-
-                    # simple links (formulaire, recours)
-                    simple_links = encadre.css("a.spip_out")
-                    if simple_links:
-                        for index, link in enumerate(simple_links):
-                            file_url = link.attrib["href"]
-                            if index == 0:
-                                title = f"Formulaire"
-                            else:
-                                title = link.css("::text").get().strip()
-
-                            doc_item = DocumentItem(
-                                title=title,
-                                category_local=category_local,
-                                authority=AUTHORITY,
-                                full_info=full_info,
-                                project=project,
-                                source_page_url=response.request.url,
-                                source_file_url=response.urljoin(file_url),
-                                year=page_year,
-                            )
-
-                            if not doc_item["source_file_url"] in self.event_data:
-                                yield response.follow(
-                                    doc_item["source_file_url"],
-                                    method="HEAD",
-                                    callback=self.parse_document_headers,
-                                    cb_kwargs=dict(doc_item=doc_item),
-                                )
-
-        elif category_local == "Saisines":
-
-            download_boxes = response.css("#main .texte-article .fr-download")
-
-            for dl_box in download_boxes:
-
-                doc_title = "".join(
-                    [
-                        x.strip()
-                        for x in dl_box.css("a.fr-download__link::text").getall()
-                        if x.strip()
-                    ]
-                )
-                doc_link = dl_box.css("a.fr-download__link").attrib["href"]
-
-                preceding_p = dl_box.xpath("./preceding-sibling::p")[-1]
-
-                project = preceding_p.css("strong").css("::text").get()
-
-                date_string = preceding_p.css("::text")[-1].get()
-
-                year_match = re.search("20\d\d", date_string)
-
-                year = int(year_match.group())
-
-                for y in self.target_years:
-
-                    if year == y:
-
-                        doc_item = DocumentItem(
-                            title=f"Accusé de reception - {doc_title}",
-                            project=project,
-                            authority=AUTHORITY,
-                            category_local=category_local,
-                            source_file_url=response.urljoin(doc_link),
-                            source_page_url=response.request.url,
-                            year=str(year),
-                        )
-
-                        if not doc_item["source_file_url"] in self.event_data:
-                            yield response.follow(
-                                doc_item["source_file_url"],
-                                method="HEAD",
-                                callback=self.parse_document_headers,
-                                cb_kwargs=dict(doc_item=doc_item),
-                            )
+        self.page_parsed(response.request.url)
+        self.page_done(response.request)
 
     def parse_document_headers(self, response, doc_item):  # à relire
         """Gets the headers of a document to extract its publication date (Last-Modified header)."""
 
-        self.check_upload_limit()
-        self.check_time_limit()
-
         # Use Last-Modified header as date for the document
         # Note: this is UTC
-        doc_item["headers"] = dict(response.headers.to_unicode_dict())
+        headers = response.headers.to_unicode_dict()
+        if self.settings.getbool("COMPACT_ITEMS"):
+            headers = {
+                name: headers[name] for name in DOCUMENT_HEADERS if name in headers
+            }
+        doc_item["headers"] = dict(headers)
         last_modified = response.headers.get("Last-Modified").decode("utf-8")
 
         doc_item["publication_lastmodified"] = last_modified
 
-        yield doc_item
+        # Cache the headers for the next runs, in case the document does not
+        # make it to event data (upload limit, time limit, errors)
+        if self.settings.getint("HEAD_CACHE_TTL"):
+            self.scraper_state.setdefault("head_cache", {})[
+                doc_item["source_file_url"]
+            ] = {
+                "last_modified": last_modified,
+                "size": doc_item["headers"].get("Content-Length"),
+                "fetched_at": datetime.now().isoformat(timespec="seconds"),
+            }
+
+        # No time limit check: in-flight HEAD requests are drained when the
+        # time budget is exhausted
+        self.check_upload_limit()
+
+        yield document_item(doc_item)